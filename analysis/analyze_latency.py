@@ -1,14 +1,25 @@
 import csv
 import os
+from typing import Optional
 
 
-def parse_csv(filename: str) -> list[dict]:
+def parse_csv(filename: str, session_id: Optional[int] = None) -> dict[int, float]:
+    """Map state number to timestamp, keeping only session_id's lines when the log has a session id column."""
     with open(filename, "r") as f:
         reader = csv.reader(f)
-        data = [(int(row[1]), float(row[0])) for row in reader]
+        data = [(int(row[1]), float(row[0])) for row in reader
+                if session_id is None or len(row) < 3 or int(row[2]) == session_id]
         return dict(data)
 
 
+def log_session_id(filename: str) -> Optional[int]:
+    """The session id a client log was written under, or None for logs that predate session ids."""
+    with open(filename, "r") as f:
+        for row in csv.reader(f):
+            return int(row[2]) if len(row) > 2 else None
+    return None
+
+
 def backfill(
     latency: dict[int, float],
     client_log: dict[int, float],
@@ -48,7 +59,7 @@ def calculate_statistics(latency: dict[int, float]) -> dict[str, float]:
 
 def main():
     client_log = parse_csv("../testbed/logs/client_out.log")
-    server_log = parse_csv("../testbed/logs/output.log")
+    server_log = parse_csv("../testbed/logs/output.log", log_session_id("../testbed/logs/client_out.log"))
 
     latency = calculate_latency(client_log, server_log)
     stats = calculate_statistics(latency)
@@ -12,7 +12,7 @@ import matplotlib.pyplot as plt
 from pathlib import Path
 
 # Import functions from analyze_latency.py
-from analyze_latency import parse_csv, calculate_latency
+from analyze_latency import parse_csv, calculate_latency, log_session_id
 
 RESULTS_DIR = Path(__file__).parent.parent / "packetloss_test_results"
 OUTPUT_DIR = Path(__file__).parent
@@ -30,7 +30,7 @@ def calculate_aoi_for_iteration(iteration_path):
 
     try:
         client_log = parse_csv(str(client_out))
-        server_log = parse_csv(str(output_log))
+        server_log = parse_csv(str(output_log), log_session_id(str(client_out)))
     except (FileNotFoundError, Exception):
         return []
 
@@ -198,12 +198,20 @@ import csv
 import sys
 import os
 
-def parse_csv(filename: str) -> dict:
+def parse_csv(filename: str, session_id=None) -> dict:
+    # server lines end in the client's session id; only that client's states count
     with open(filename, "r") as f:
         reader = csv.reader(f)
-        data = [(int(row[1]), float(row[0])) for row in reader]
+        data = [(int(row[1]), float(row[0])) for row in reader
+                if session_id is None or len(row) < 3 or int(row[2]) == session_id]
         return dict(data)
 
+def log_session_id(filename: str):
+    with open(filename, "r") as f:
+        for row in csv.reader(f):
+            return int(row[2]) if len(row) > 2 else None
+    return None
+
 def backfill(latency, client_log, server_log):
     latest_time = None
     for key in sorted(latency.keys(), reverse=True):
@@ -244,7 +252,7 @@ def main():
 
     try:
         client_log = parse_csv(client_log_path)
-        server_log = parse_csv(server_log_path)
+        server_log = parse_csv(server_log_path, log_session_id(client_log_path))
     except Exception as e:
         print(f"Error reading logs: {e}", file=sys.stderr)
         return
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Benchmark State.apply over the test_states.txt corpus and scaled-up screens.
+
+Usage: python3 mosh/benchmarks/bench_apply.py [--states PATH] [--repeat N]
+"""
+
+import argparse
+import json
+import time
+
+from corpus import DEFAULT_STATES_PATH, load_corpus, scale
+from diff import get_opcodes
+from state import State
+
+
+def json_patch(old, new):
+    # the JSON opcode format State.apply still accepts from older senders
+    patch = []
+    for tag, i1, i2, j1, j2 in get_opcodes(old, new):
+        if tag == "equal":
+            patch.append(("equal", i1, i2, j1, j2))
+        elif tag == "delete":
+            patch.append(("delete", i1, i2, old[i1:i2]))
+        elif tag == "insert":
+            patch.append(("insert", j1, j2, new[j1:j2]))
+        else:
+            patch.append(("replace", i1, i2, j1, j2, old[i1:i2], new[j1:j2]))
+    return json.dumps(patch)
+
+
+def apply_per_char(state, patch):
+    # the original implementation, which pushed one str object per character
+    result = []
+    for op in json.loads(patch):
+        if op[0] == "equal":
+            result.extend(state.string[op[1]:op[2]])
+        elif op[0] in ("insert", "replace"):
+            result.extend(op[-1])
+    return "".join(result)
+
+
+def run(label, states, repeat):
+    pairs = list(zip(states, states[1:]))
+    binary = [(State(a), State(a).generate_patch(State(b))) for a, b in pairs]
+    legacy = [(State(a), json_patch(a, b)) for a, b in pairs]
+
+    results = {}
+    for name, cases, fn in [
+        ("binary", binary, lambda s, p: s.apply(p)),
+        ("json", legacy, lambda s, p: s.apply(p)),
+        ("json per-char", legacy, apply_per_char),
+    ]:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for state, patch in cases:
+                fn(state, patch)
+            best = min(best, time.perf_counter() - start)
+        results[name] = best / len(cases)
+
+    avg_len = sum(len(s) for s in states) / len(states)
+    print(f"{label} ({len(pairs)} applies, avg {avg_len:.0f} chars)")
+    for name, per_apply in results.items():
+        print(f"  {name:<14} {per_apply * 1e6:10.1f} us/apply {per_apply * 1e9 / avg_len:8.2f} ns/char")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--states", default=DEFAULT_STATES_PATH)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.states)
+    run("corpus", corpus, args.repeat)
+    for target_length in (1_000, 10_000):
+        run(f"scaled to {target_length}", scale(corpus[:200], target_length), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the state/diff/transport hot path.
+
+Replays the generate_states corpus (copies of it scaled to 1k-100k chars, and a
+200x60 screen that scrolls and gets redrawn) through State.generate_patch,
+State.apply, TransportInstruction.marshall/unmarshal and Packet.pack/unpack
+(plus the in-place receive decode), reporting ops/sec, p99 latency and, via
+tracemalloc, the memory each op allocates (peak traced bytes above where the call
+started, result included) and the blocks still held once its result is dropped.
+
+Usage:
+    python3 mosh/benchmarks/bench_suite.py --save baseline.json
+    python3 mosh/benchmarks/bench_suite.py --compare baseline.json
+
+To hold the diff engine against the original backend:
+    MOSH_DIFF_ENGINE=difflib python3 mosh/benchmarks/bench_suite.py --save difflib.json
+    python3 mosh/benchmarks/bench_suite.py --compare difflib.json
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from corpus import DEFAULT_STATES_PATH, load_corpus, scale, screens
+from datagram import Packet
+from state import State
+from transport import TransportInstruction
+
+SIZES = [1_000, 10_000, 100_000]
+# fewer transitions at the big sizes, the corpus would take minutes to diff
+MAX_PAIRS = {None: 999, 1_000: 500, 10_000: 200, 100_000: 50}
+
+
+def build_cases(states):
+    pairs = [(State(a), State(b)) for a, b in zip(states, states[1:])]
+    patches = [old.generate_patch(new) for old, new in pairs]
+    instructions = [TransportInstruction(i, i + 1, i, i - 1, patch) for i, patch in enumerate(patches)]
+    payloads = [t.marshall() for t in instructions]
+    packets = [Packet(True, i, i & 0xFFFF, i & 0xFFFF, -50, payload) for i, payload in enumerate(payloads)]
+    datagrams = [p.pack() for p in packets]
+    recv_buffer = bytearray(max(len(d) for d in datagrams))
+
+    def recv_decode(datagram):
+        # what Transporter does per packet: parse the reused receive buffer in place
+        recv_buffer[:len(datagram)] = datagram
+        return TransportInstruction.unmarshal(Packet.unpack_from(recv_buffer, len(datagram)).payload)
+
+    return {
+        "generate_patch": [(lambda old=old, new=new: old.generate_patch(new)) for old, new in pairs],
+        "apply": [(lambda old=old, patch=patch: old.apply(patch)) for (old, _), patch in zip(pairs, patches)],
+        "marshall": [t.marshall for t in instructions],
+        "unmarshal": [(lambda payload=payload: TransportInstruction.unmarshal(payload)) for payload in payloads],
+        "pack": [p.pack for p in packets],
+        "unpack": [(lambda datagram=datagram: Packet.unpack(datagram)) for datagram in datagrams],
+        "recv_decode": [(lambda datagram=datagram: recv_decode(datagram)) for datagram in datagrams],
+    }
+
+
+def measure(calls, repeat):
+    timings = []
+    for _ in range(repeat):
+        for call in calls:
+            start = time.perf_counter_ns()
+            call()
+            timings.append(time.perf_counter_ns() - start)
+    timings.sort()
+
+    # allocations are counted in a separate pass so tracing does not skew the timings
+    tracemalloc.start()
+    peak_bytes = 0
+    for call in calls:
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        call()
+        peak_bytes += tracemalloc.get_traced_memory()[1] - start
+    # whatever survives the call once its result is gone: caches, interned content, leaks
+    before = tracemalloc.take_snapshot()
+    for call in calls:
+        call()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+
+    total_s = sum(timings) / 1e9
+    return {
+        "ops_per_sec": len(timings) / total_s if total_s > 0 else float("inf"),
+        "mean_us": sum(timings) / len(timings) / 1e3,
+        "p99_us": timings[min(len(timings) - 1, int(len(timings) * 0.99))] / 1e3,
+        "peak_bytes_per_op": peak_bytes / len(calls),
+        "retained_blocks_per_op": retained / len(calls),
+    }
+
+
+def run(corpus, sizes, repeat):
+    results = {}
+    workloads = [("corpus" if size is None else f"{size // 1000}k",
+                  (corpus if size is None else scale(corpus, size))[:MAX_PAIRS[size] + 1])
+                 for size in [None] + sizes]
+    workloads.append(("screen", screens()))
+    for label, states in workloads:
+        for op, calls in build_cases(states).items():
+            result = measure(calls, repeat)
+            results[f"{label}/{op}"] = result
+            print(f"{label:>7} {op:<15} {result['ops_per_sec']:>12.0f} ops/s "
+                  f"{result['mean_us']:>10.1f} us mean {result['p99_us']:>10.1f} us p99 "
+                  f"{result['peak_bytes_per_op']:>10.0f} B/op peak {result['retained_blocks_per_op']:>6.1f} retained blocks/op")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the change in mean time per benchmark and return the names that regressed."""
+    regressions = []
+    print(f"\nCompared to baseline (regression threshold {threshold:.0%}):")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result["mean_us"] / baseline[name]["mean_us"] - 1
+        marker = ""
+        if change > threshold:
+            marker = "  REGRESSION"
+            regressions.append(name)
+        print(f"  {name:<26} {change:+8.1%}{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--states", default=DEFAULT_STATES_PATH)
+    parser.add_argument("--sizes", type=int, nargs="*", default=SIZES, help="scaled state sizes in chars")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        MAX_PAIRS.setdefault(size, 50)
+    results = run(load_corpus(args.states), args.sizes, args.repeat)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""State corpora shared by the benchmarks."""
+
+import os
+import random
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "testbed"))
+
+DEFAULT_STATES_PATH = os.path.join(HERE, "..", "..", "testbed", "test_states.txt")
+
+
+def load_corpus(path=DEFAULT_STATES_PATH):
+    """Read test_states.txt, or regenerate the same corpus with bulk_test.generate_states."""
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return [line.strip() for line in f if line.strip()]
+    from bulk_test import generate_states
+    return generate_states(num_states=1000, max_length=250)
+
+
+def scale(corpus, target_length, seed=0):
+    """Embed each corpus state in a fixed screen of roughly target_length chars.
+
+    Consecutive scaled states differ only where the corpus states differ, the way
+    a large terminal screen changes a few lines at a time.
+    """
+    rng = random.Random(seed)
+    words = " ".join(corpus).split()
+    filler = []
+    length = 0
+    while length < target_length:
+        filler.append(rng.choice(words))
+        length += len(filler[-1]) + 1
+    background = " ".join(filler)
+    middle = len(background) // 2
+    return [background[:middle] + state + background[middle + len(state):target_length] for state in corpus]
+
+
+def screens(width=200, height=60, count=60, seed=0):
+    """A full-size terminal screen going through scrolls, small edits and the occasional full redraw.
+
+    These are the bursty updates where a char-level diff has the most work to do.
+    """
+    rng = random.Random(seed)
+    alphabet = "abcdefghijklmnopqrstuvwxyz     "
+
+    def row():
+        return "".join(rng.choice(alphabet) for _ in range(width))
+
+    rows = [row() for _ in range(height)]
+    states = ["\n".join(rows)]
+    for i in range(count):
+        if i % 10 == 9:
+            rows = [row() for _ in range(height)]
+        elif i % 2 == 0:
+            lines = rng.randint(1, 3)
+            rows = rows[lines:] + [row() for _ in range(lines)]
+        else:
+            y, x = rng.randrange(height), rng.randrange(width - 8)
+            rows[y] = rows[y][:x] + row()[:8] + rows[y][x + 8:]
+        states.append("\n".join(rows))
+    return states
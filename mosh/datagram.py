@@ -1,7 +1,14 @@
 import struct
 from dataclasses import dataclass
 
-DATAGRAM_FORMAT_STRING = '!QHHh'
+# nonce (direction bit | session flag | seq), session id, ts, ts_reply, signal strength
+DATAGRAM_FORMAT_STRING = '!QIHHh'
+DATAGRAM_HEADER = struct.Struct(DATAGRAM_FORMAT_STRING)
+HEADER_LENGTH = DATAGRAM_HEADER.size
+# Peers from before session ids send '!QHHh' and never set this nonce bit
+# (their seq starts at 0), so their datagrams still parse, as session 0.
+SESSION_FLAG = 1 << 62
+LEGACY_HEADER = struct.Struct('!QHHh')
 
 @dataclass
 class Packet:
@@ -10,7 +17,8 @@ class Packet:
     ts: int
     ts_reply: int
     signal_strength_dbm: int
-    payload: bytes
+    payload: bytes  # a memoryview into the receive buffer when built by unpack_from
+    session_id: int = 0  # lets one server socket tell its clients apart
 
     def pack(self) -> bytes:
         direction = self.direction
@@ -19,39 +27,54 @@ class Packet:
         ts_reply = self.ts_reply
         signal_strength_dbm = self.signal_strength_dbm
         payload = self.payload
+        session_id = self.session_id
 
-        assert 0 <= seq < (1 << 63)
+        assert 0 <= seq < SESSION_FLAG
+        assert 0 <= session_id <= 0xFFFFFFFF
 
         dir_bit = int(direction)
-        nonce = (dir_bit << 63) | seq
+        nonce = (dir_bit << 63) | SESSION_FLAG | seq
 
         ts = ts & 0xFFFF
         assert 0 <= ts_reply <= 0xFFFF
         assert -127 <= signal_strength_dbm <= 0
 
-        header = struct.pack(DATAGRAM_FORMAT_STRING, nonce, ts, ts_reply, signal_strength_dbm)
+        header = DATAGRAM_HEADER.pack(nonce, session_id, ts, ts_reply, signal_strength_dbm)
 
-        # TODO: What do we do if this is larger than the MTU of the network?
+        # payloads are kept within the path MTU by Transporter.send (see fragment.py)
         return header + payload
 
     @staticmethod
     def unpack(value: bytes) -> 'Packet':
-        header_length = struct.calcsize(DATAGRAM_FORMAT_STRING)
+        return Packet._with_header(value, value, len(value))
 
-        nonce, ts, ts_reply, signal_strength_dbm = struct.unpack_from(DATAGRAM_FORMAT_STRING, value, offset=0)
-        payload = value[header_length:]
+    @staticmethod
+    def unpack_from(buffer, length: int) -> 'Packet':
+        """Parse the first length bytes of buffer without copying; payload is a memoryview into it."""
+        return Packet._with_header(buffer, memoryview(buffer), length)
+
+    @staticmethod
+    def _with_header(buffer, payload_source, length: int) -> 'Packet':
+        if DATAGRAM_HEADER.size <= length and buffer[0] & (SESSION_FLAG >> 56):
+            nonce, session_id, ts, ts_reply, signal_strength_dbm = DATAGRAM_HEADER.unpack_from(buffer, 0)
+            payload = payload_source[DATAGRAM_HEADER.size:length]
+        else:
+            nonce, ts, ts_reply, signal_strength_dbm = LEGACY_HEADER.unpack_from(buffer, 0)
+            session_id = 0
+            payload = payload_source[LEGACY_HEADER.size:length]
 
         return Packet(
                     bool(nonce & (1 << 63)),
-                    nonce & ((1 << 63) - 1),
+                    nonce & (SESSION_FLAG - 1),
                     ts,
                     ts_reply,
                     signal_strength_dbm,
-                    payload
+                    payload,
+                    session_id
               )
 
 if __name__ == "__main__":
-    original_packet = Packet(True, 7, 10, 5, -50, 'abc'.encode('utf-8'))
+    original_packet = Packet(True, 7, 10, 5, -50, 'abc'.encode('utf-8'), 0xC0FFEE)
     back = Packet.unpack(original_packet.pack())
     assert original_packet.direction == back.direction
     assert original_packet.seq == back.seq
@@ -59,3 +82,16 @@ if __name__ == "__main__":
     assert original_packet.ts_reply == back.ts_reply
     assert original_packet.signal_strength_dbm == back.signal_strength_dbm
     assert original_packet.payload == back.payload
+    assert original_packet.session_id == back.session_id
+
+    buffer = bytearray(64)
+    datagram = original_packet.pack()
+    buffer[:len(datagram)] = datagram
+    view = Packet.unpack_from(buffer, len(datagram))
+    assert view.seq == 7 and view.payload == b'abc'
+    assert isinstance(view.payload, memoryview) and view.payload.obj is buffer
+
+    # a peer without session ids
+    legacy = Packet.unpack(LEGACY_HEADER.pack((1 << 63) | 7, 10, 5, -50) + b'abc')
+    assert (legacy.direction, legacy.seq, legacy.ts, legacy.ts_reply) == (True, 7, 10, 5)
+    assert legacy.session_id == 0 and legacy.payload == b'abc'
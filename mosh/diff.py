@@ -0,0 +1,276 @@
+import difflib
+import os
+from typing import Callable, Optional
+
+# An opcode has the same shape as difflib.SequenceMatcher.get_opcodes():
+# (tag, i1, i2, j1, j2) where tag is one of equal/delete/insert/replace
+Opcode = tuple[str, int, int, int, int]
+
+DIFF_ENGINE = os.environ.get("MOSH_DIFF_ENGINE", "myers")
+# upper bound on the edit distance Myers will search before giving up on a minimal diff
+MAX_EDITS = int(os.environ.get("MOSH_DIFF_MAX_EDITS", 1024))
+# Round d of the search costs d + 1 steps, so a search to edit distance D costs about D^2 / 2.
+# It may take WORK_PER_CHAR steps per differing char (at least MIN_WORK), which keeps a
+# failed search well below what difflib spends on the same input.
+WORK_PER_CHAR = 0.25
+MIN_WORK = 2048
+
+
+def difflib_opcodes(a: str, b: str) -> list[Opcode]:
+    """The original backend, kept around so results can be compared."""
+    return difflib.SequenceMatcher(None, a, b).get_opcodes()
+
+
+def myers_opcodes(a: str, b: str, max_edits: Optional[int] = None, by_lines: bool = True) -> list[Opcode]:
+    """Myers O(ND) diff.
+
+    The common prefix and suffix are stripped first since terminal updates
+    usually only touch a small region. If the remaining middle needs more than
+    max_edits insertions/deletions, or more search work than its length
+    allows, we diff it line by line instead (a scroll is a few inserted and
+    deleted lines), and failing that replace it wholesale.
+    """
+    if max_edits is None:
+        max_edits = MAX_EDITS
+
+    n, m = len(a), len(b)
+    prefix = 0
+    while prefix < n and prefix < m and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and suffix < m - prefix and a[n - 1 - suffix] == b[m - 1 - suffix]:
+        suffix += 1
+
+    opcodes: list[Opcode] = []
+    if prefix > 0:
+        opcodes.append(("equal", 0, prefix, 0, prefix))
+
+    a_mid = a[prefix:n - suffix]
+    b_mid = b[prefix:m - suffix]
+    moves = _shortest_edit(a_mid, b_mid, max_edits, _work_budget(a_mid, b_mid))
+    line_opcodes = None
+    if moves is None and by_lines:
+        line_opcodes = _line_opcodes(a_mid, b_mid, prefix, max_edits)
+    if moves is not None:
+        opcodes.extend(_moves_to_opcodes(moves, prefix))
+    elif line_opcodes is not None:
+        opcodes.extend(line_opcodes)
+    else:
+        opcodes.append(("replace", prefix, n - suffix, prefix, m - suffix))
+
+    if suffix > 0:
+        opcodes.append(("equal", n - suffix, n, m - suffix, m))
+    return opcodes
+
+
+def _work_budget(a, b) -> int:
+    return max(MIN_WORK, int(WORK_PER_CHAR * (len(a) + len(b))))
+
+
+def _line_opcodes(a: str, b: str, base: int, max_edits: int) -> Optional[list[Opcode]]:
+    """Diff a and b as sequences of lines, then refine each replaced block char by char.
+
+    Returns None if there are too few lines to help or the line diff is over budget too.
+    """
+    a_lines = a.splitlines(keepends=True)
+    b_lines = b.splitlines(keepends=True)
+    if len(a_lines) < 2 and len(b_lines) < 2:
+        return None
+    moves = _shortest_edit(a_lines, b_lines, max_edits, _work_budget(a_lines, b_lines))
+    if moves is None:
+        return None
+
+    # char offset of each line start, plus the end
+    a_starts = [0]
+    for line in a_lines:
+        a_starts.append(a_starts[-1] + len(line))
+    b_starts = [0]
+    for line in b_lines:
+        b_starts.append(b_starts[-1] + len(line))
+
+    opcodes: list[Opcode] = []
+    for tag, i1, i2, j1, j2 in _moves_to_opcodes(moves, 0):
+        x1, x2, y1, y2 = a_starts[i1], a_starts[i2], b_starts[j1], b_starts[j2]
+        if tag == "replace":
+            opcodes.extend((sub_tag, base + x1 + s1, base + x1 + s2, base + y1 + t1, base + y1 + t2)
+                           for sub_tag, s1, s2, t1, t2 in myers_opcodes(a[x1:x2], b[y1:y2], max_edits, by_lines=False))
+        else:
+            opcodes.append((tag, base + x1, base + x2, base + y1, base + y2))
+    return opcodes
+
+
+def _shortest_edit(a, b, max_edits: int, max_work: int) -> Optional[list[tuple[int, int, int, int]]]:
+    """Return the path through the edit graph as (x1, y1, x2, y2) steps.
+
+    a and b are strings or lists of lines. Returns None past max_edits, or once
+    the search has taken max_work steps.
+    """
+    n, m = len(a), len(b)
+    if n == 0 and m == 0:
+        return []
+    if n == 0 or m == 0:
+        return [(0, 0, n, m)] if n + m <= max_edits else None
+    if abs(n - m) > max_edits or (abs(n - m) + 1) ** 2 > 2 * max_work:
+        return None  # the edit distance is at least |n - m|, so this cannot finish in budget
+
+    max_d = min(n + m, max_edits)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    # trace[d] holds v[-d-1 .. d+1] as it was before round d
+    trace: list[list[int]] = []
+
+    work = 0
+    for d in range(max_d + 1):
+        work += d + 1
+        if work > max_work:
+            return None
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return None
+
+
+def _backtrack(trace: list[list[int]], n: int, m: int) -> list[tuple[int, int, int, int]]:
+    moves = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        base = d + 1  # index of k == 0 within the stored slice
+        k = x - y
+        if k == -d or (k != d and v[base + k - 1] < v[base + k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[base + prev_k]
+        prev_y = prev_x - prev_k
+
+        while x > prev_x and y > prev_y:
+            moves.append((x - 1, y - 1, x, y))
+            x -= 1
+            y -= 1
+        if d > 0:
+            moves.append((prev_x, prev_y, x, y))
+        x, y = prev_x, prev_y
+
+    moves.reverse()
+    return moves
+
+
+def _moves_to_opcodes(moves: list[tuple[int, int, int, int]], base: int) -> list[Opcode]:
+    opcodes: list[Opcode] = []
+    pending: Optional[list[int]] = None  # [i1, i2, j1, j2] of the current non-equal run
+    equal: Optional[list[int]] = None
+
+    def flush_pending():
+        nonlocal pending
+        if pending is not None:
+            i1, i2, j1, j2 = pending
+            tag = "replace" if i1 != i2 and j1 != j2 else ("delete" if i1 != i2 else "insert")
+            opcodes.append((tag, base + i1, base + i2, base + j1, base + j2))
+            pending = None
+
+    def flush_equal():
+        nonlocal equal
+        if equal is not None:
+            i1, i2, j1, j2 = equal
+            opcodes.append(("equal", base + i1, base + i2, base + j1, base + j2))
+            equal = None
+
+    for x1, y1, x2, y2 in moves:
+        if x2 - x1 == y2 - y1:
+            flush_pending()
+            if equal is None:
+                equal = [x1, x2, y1, y2]
+            else:
+                equal[1], equal[3] = x2, y2
+        else:
+            flush_equal()
+            if pending is None:
+                pending = [x1, x2, y1, y2]
+            else:
+                pending[1], pending[3] = x2, y2
+    flush_pending()
+    flush_equal()
+    return opcodes
+
+
+ENGINES: dict[str, Callable[[str, str], list[Opcode]]] = {
+    "difflib": difflib_opcodes,
+    "myers": myers_opcodes,
+}
+
+
+def get_opcodes(a: str, b: str, engine: Optional[str] = None) -> list[Opcode]:
+    return ENGINES[engine or DIFF_ENGINE](a, b)
+
+
+if __name__ == "__main__":
+    import random
+
+    def check(a, b, **kwargs):
+        ops = myers_opcodes(a, b, **kwargs)
+        rebuilt = "".join(b[j1:j2] if tag != "equal" else a[i1:i2] for tag, i1, i2, j1, j2 in ops)
+        assert rebuilt == b, (a, b, ops)
+        i = j = 0
+        for tag, i1, i2, j1, j2 in ops:
+            assert (i1, j1) == (i, j), ops
+            if tag == "equal":
+                assert a[i1:i2] == b[j1:j2]
+            i, j = i2, j2
+        assert (i, j) == (len(a), len(b))
+        return ops
+
+    assert check("", "") == []
+    assert check("abc", "abc") == [("equal", 0, 3, 0, 3)]
+    assert check("", "abc") == [("insert", 0, 0, 0, 3)]
+    assert check("abc", "") == [("delete", 0, 3, 0, 0)]
+    assert check("abcabba", "cbabac")
+    assert check("the quick fox", "the slow fox") == [
+        ("equal", 0, 4, 0, 4),
+        ("replace", 4, 9, 4, 8),
+        ("equal", 9, 13, 8, 12),
+    ]
+    # the cutoff falls back to replacing the differing middle
+    assert check("xaaaay", "xbbbby", max_edits=2) == [
+        ("equal", 0, 1, 0, 1),
+        ("replace", 1, 5, 1, 5),
+        ("equal", 5, 6, 5, 6),
+    ]
+
+    rng = random.Random(0)
+    for _ in range(500):
+        a = "".join(rng.choice("ab c") for _ in range(rng.randint(0, 30)))
+        b = "".join(rng.choice("ab c") for _ in range(rng.randint(0, 30)))
+        ops = check(a, b)
+        # Myers is minimal, so it never does worse than difflib
+        cost = sum((i2 - i1) + (j2 - j1) for tag, i1, i2, j1, j2 in ops if tag != "equal")
+        ref = sum((i2 - i1) + (j2 - j1) for tag, i1, i2, j1, j2 in difflib_opcodes(a, b) if tag != "equal")
+        assert cost <= ref, (a, b)
+
+    def edit_cost(ops):
+        return sum((i2 - i1) + (j2 - j1) for tag, i1, i2, j1, j2 in ops if tag != "equal")
+
+    # a scrolled 200x60 screen is too far apart char by char, but only a few lines apart
+    rows = ["".join(rng.choice("abcdefghij klmnop") for _ in range(200)) for _ in range(63)]
+    screen, scrolled = "\n".join(rows[:60]), "\n".join(rows[3:])
+    assert edit_cost(check(screen, scrolled)) == 2 * 3 * 201
+    # the rows around a line that changed still come out char by char
+    edited = scrolled.replace(rows[30][:10], "0123456789", 1)
+    assert edit_cost(check(screen, edited)) == 2 * 3 * 201 + 20
+
+    # the fallbacks stay correct when the budget forces them
+    MIN_WORK = 8
+    for _ in range(500):
+        a = "".join(rng.choice("ab\n") for _ in range(rng.randint(0, 60)))
+        b = "".join(rng.choice("ab\n") for _ in range(rng.randint(0, 60)))
+        check(a, b)
@@ -0,0 +1,140 @@
+import struct
+import time
+from collections import OrderedDict
+from typing import Optional, Union
+
+# Payloads that do not fit in one datagram are split into fragments, each
+# carrying this header in front of its slice of the payload:
+#   marker byte, message id, fragment index with FINAL_FRAGMENT set on the last one.
+# Unfragmented payloads go out as-is; instructions start with their version
+# byte (or '{' for legacy JSON) and never with the marker.
+FRAGMENT_MARKER = 0x80
+FRAGMENT_HEADER = struct.Struct('!BIH')
+FINAL_FRAGMENT = 0x8000
+MAX_FRAGMENTS = FINAL_FRAGMENT
+
+# IPv4 + UDP headers in front of every datagram
+IP_UDP_OVERHEAD = 28
+
+# incomplete messages held at once, and how long one may wait for its missing fragments
+MAX_PENDING_MESSAGES = 32
+REASSEMBLY_TIMEOUT = 2.0
+
+
+def is_fragment(payload: Union[bytes, memoryview]) -> bool:
+    return len(payload) > 0 and payload[0] == FRAGMENT_MARKER
+
+
+def fragment(payload: bytes, message_id: int, max_size: int) -> list[bytes]:
+    """Split payload into pieces of at most max_size bytes, headers included.
+
+    A payload that already fits is returned whole and without a header.
+    """
+    if len(payload) <= max_size:
+        return [payload]
+    chunk = max_size - FRAGMENT_HEADER.size
+    assert chunk > 0, f"Fragment size {max_size} leaves no room for data"
+    count = (len(payload) + chunk - 1) // chunk
+    assert count <= MAX_FRAGMENTS, f"Payload of {len(payload)} bytes needs too many fragments"
+
+    message_id &= 0xFFFFFFFF
+    fragments = []
+    for index in range(count):
+        flags = FINAL_FRAGMENT if index == count - 1 else 0
+        header = FRAGMENT_HEADER.pack(FRAGMENT_MARKER, message_id, index | flags)
+        fragments.append(header + payload[index * chunk:(index + 1) * chunk])
+    return fragments
+
+
+class _PendingMessage:
+    def __init__(self, now: float):
+        self.first_seen = now
+        self.pieces: dict[int, bytes] = {}
+        self.total: Optional[int] = None  # known once the final fragment arrives
+
+
+class Reassembler:
+    """Collects fragments until their message is complete.
+
+    At most max_pending messages are held; the oldest is dropped to make room,
+    and any message that has not completed within timeout seconds is dropped.
+    """
+    def __init__(self, max_pending: int = MAX_PENDING_MESSAGES, timeout: float = REASSEMBLY_TIMEOUT):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pending: OrderedDict[int, _PendingMessage] = OrderedDict()
+        self.messages_reassembled = 0
+        self.messages_expired = 0
+
+    def add(self, payload: Union[bytes, memoryview], now: Optional[float] = None) -> Optional[Union[bytes, memoryview]]:
+        """Feed one received payload; returns the whole message once it is complete, else None.
+
+        Payloads that are not fragments are returned unchanged (and uncopied).
+        """
+        if not is_fragment(payload):
+            return payload
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+
+        _, message_id, index = FRAGMENT_HEADER.unpack_from(payload, 0)
+        message = self._pending.get(message_id)
+        if message is None:
+            if len(self._pending) >= self.max_pending:
+                self._pending.popitem(last=False)
+                self.messages_expired += 1
+            message = self._pending[message_id] = _PendingMessage(now)
+
+        if index & FINAL_FRAGMENT:
+            index &= ~FINAL_FRAGMENT
+            message.total = index + 1
+        # copied, the payload may be a view into a buffer that is about to be reused
+        message.pieces.setdefault(index, bytes(payload[FRAGMENT_HEADER.size:]))
+
+        if message.total is None or len(message.pieces) < message.total:
+            return None
+        del self._pending[message_id]
+        self.messages_reassembled += 1
+        return b''.join(message.pieces[i] for i in range(message.total))
+
+    def _expire(self, now: float) -> None:
+        while self._pending:
+            message_id, message = next(iter(self._pending.items()))
+            if now - message.first_seen < self.timeout:
+                break
+            del self._pending[message_id]
+            self.messages_expired += 1
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "reassembled": self.messages_reassembled,
+            "expired": self.messages_expired,
+        }
+
+
+if __name__ == "__main__":
+    payload = bytes(range(256)) * 20
+    pieces = fragment(payload, 7, 1000)
+    assert len(pieces) == 6 and all(len(p) <= 1000 for p in pieces)
+    assert fragment(b'\x01abc', 7, 1000) == [b'\x01abc']
+
+    r = Reassembler()
+    assert r.add(b'\x01abc') == b'\x01abc'
+    # out of order and duplicated fragments still reassemble
+    for p in reversed(pieces[1:]):
+        assert r.add(p, now=0.0) is None
+    assert r.add(pieces[3], now=0.0) is None
+    assert r.add(memoryview(pieces[0]), now=0.0) == payload
+    assert len(r) == 0 and r.stats()["reassembled"] == 1
+
+    # incomplete messages are dropped after the timeout, or when too many pile up
+    r.add(pieces[0], now=0.0)
+    r.add(fragment(payload, 8, 1000)[0], now=REASSEMBLY_TIMEOUT + 1)
+    assert len(r) == 1 and r.stats()["expired"] == 1
+    small = Reassembler(max_pending=2)
+    for message_id in range(3):
+        small.add(fragment(payload, message_id, 1000)[0], now=0.0)
+    assert len(small) == 2 and small.stats()["expired"] == 1
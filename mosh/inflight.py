@@ -4,42 +4,69 @@ from typing import Optional
 # we can form a congestion window
 
 class InflightTracker:
+    """Sent but unacked states and the states they were diffed against.
+
+    Acks are cumulative, so each one drops a prefix of inflight_state_numbers
+    with a single bisect and slice delete. Only in-flight states are kept;
+    everything at or below highest_ack is forgotten as soon as it is acked.
+    """
     def __init__(self):
         self.inflight_state_numbers: SortedList[int] = SortedList()
-        self.dependencies: dict[int, Optional[int]] = {}
-        self.inflight_dependencies: SortedList[int] = SortedList()
-        self.highest_ack: int = 0 # we start synced at state 0, which is State("") 
-        # TODO: discard old states and dependencies
-        # not important for correctness, just efficiency
+        self.dependencies: dict[int, Optional[int]] = {}  # in-flight state -> its reference
+        self.inflight_dependencies: SortedList[int] = SortedList()  # distinct references still needed
+        self._dependency_counts: dict[int, int] = {}  # how many in-flight states use each reference
+        self.highest_ack: int = 0 # we start synced at state 0, which is State("")
 
     def acked(self, state_number: int) -> None:
-        all_acked = []
-        ind = self.inflight_state_numbers.bisect_left(state_number)
-        while ind >= 0:
-            all_acked.append(self.inflight_state_numbers[0])
-            self.inflight_state_numbers.pop(index=0)
-            ind -= 1
-        
-        assert len(all_acked) >= 1
-
-        for acked_state_number in all_acked:
-            match self.dependencies[acked_state_number]:
-                case None:
-                    pass
-                case x:
-                    self.inflight_dependencies.remove(self.dependencies[acked_state_number])
-
-        self.highest_ack = state_number
+        # duplicate and reordered acks (e.g. for retransmissions) simply find nothing left to drop
+        self.highest_ack = max(self.highest_ack, state_number)
+        end = self.inflight_state_numbers.bisect_right(state_number)
+        if end == 0:
+            return
+        all_acked = self.inflight_state_numbers[:end]
+        del self.inflight_state_numbers[:end]
+        self._release(self.dependencies.pop(acked) for acked in all_acked)
 
     def sent(self, state_number: int, depends_on: Optional[int]):
-        if depends_on is not None:
-            self.inflight_dependencies.add(depends_on)
+        if state_number <= self.highest_ack:
+            return  # already acked, nothing left to track
+
+        if state_number in self.dependencies:
+            # a retransmission supersedes the earlier send and its dependency
+            self._release([self.dependencies[state_number]])
+        else:
+            self.inflight_state_numbers.add(state_number)
 
         self.dependencies[state_number] = depends_on
-        self.inflight_state_numbers.add(state_number)
+        if depends_on is not None:
+            count = self._dependency_counts.get(depends_on, 0)
+            if count == 0:
+                self.inflight_dependencies.add(depends_on)
+            self._dependency_counts[depends_on] = count + 1
+
+    def _release(self, dependencies) -> None:
+        unused = []
+        for dependency in dependencies:
+            if dependency is None:
+                continue
+            count = self._dependency_counts[dependency] - 1
+            if count == 0:
+                del self._dependency_counts[dependency]
+                unused.append(dependency)
+            else:
+                self._dependency_counts[dependency] = count
+        if len(unused) > len(self.inflight_dependencies) // 2:
+            # cheaper to rebuild from what is left than to remove one by one
+            self.inflight_dependencies = SortedList(self._dependency_counts)
+        else:
+            for dependency in unused:
+                self.inflight_dependencies.remove(dependency)
 
     def min_inflight_dependency(self) -> Optional[int]:
-        return self.inflight_dependencies[0] if len(self.inflight_dependencies) > 0 else None 
+        return self.inflight_dependencies[0] if len(self.inflight_dependencies) > 0 else None
+
+    def __len__(self) -> int:
+        return len(self.inflight_state_numbers)
 
 if __name__ == "__main__":
     # test 1
@@ -60,3 +87,26 @@ if __name__ == "__main__":
     it.acked(3)
     assert it.min_inflight_dependency() is None
 
+    # test 2: retransmissions and duplicate or late acks
+    it = InflightTracker()
+    it.sent(1, 0)
+    it.sent(2, 1)
+    it.sent(2, 0)  # resent against the acked state
+    assert list(it.inflight_dependencies) == [0] and it._dependency_counts == {0: 2}
+    it.acked(1)
+    it.acked(1)
+    assert list(it.inflight_state_numbers) == [2] and it.min_inflight_dependency() == 0
+    it.acked(2)
+    it.acked(1)
+    assert it.highest_ack == 2 and it.min_inflight_dependency() is None
+
+    # test 3: a long session with a window of 50 unacked states keeps nothing else around
+    it = InflightTracker()
+    for n in range(1, 100_001):
+        it.sent(n, n - 1)
+        if n % 10 == 0:
+            it.acked(n - 50)
+    assert len(it) == len(it.dependencies) == 50
+    assert len(it.inflight_dependencies) == len(it._dependency_counts) == 50
+    it.acked(100_000)
+    assert len(it) == len(it.dependencies) == len(it._dependency_counts) == 0
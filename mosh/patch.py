@@ -0,0 +1,183 @@
+from typing import Iterator, Union
+from diff import Opcode
+from varint import encode_varint, decode_varint, zigzag_encode, zigzag_decode
+
+# Binary patch format (version 1):
+#   version byte, then a sequence of ops until the end of the buffer.
+#   Each op starts with a varint header (length << 1) | kind.
+#     COPY:   length characters taken from the reference state, followed by a
+#             zigzag varint giving the start relative to where the last copy ended
+#     INSERT: length bytes of UTF-8 text follow
+# Deleted and replaced reference text never goes on the wire.
+PATCH_VERSION = 1
+
+COPY = 0
+INSERT = 1
+
+# ("copy", start, length) or ("insert", text)
+Op = Union[tuple[str, int, int], tuple[str, str]]
+
+
+def ops_from_opcodes(opcodes: list[Opcode], target: str) -> list[Op]:
+    ops: list[Op] = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            ops.append(("copy", i1, i2 - i1))
+        elif tag in ("insert", "replace"):
+            ops.append(("insert", target[j1:j2]))
+        # deletes produce nothing
+    return ops
+
+
+def encode(ops: list[Op]) -> bytes:
+    out = bytearray([PATCH_VERSION])
+    _encode_ops(ops, out)
+    return bytes(out)
+
+
+def decode(patch: bytes) -> Iterator[Op]:
+    assert patch[0] == PATCH_VERSION, f"Unsupported patch version {patch[0]}"
+    return _decode_ops(patch, 1, len(patch))
+
+
+def apply(source: str, patch: bytes) -> str:
+    assert patch[0] == PATCH_VERSION, f"Unsupported patch version {patch[0]}"
+    return _apply_ops(source, patch, 1, len(patch))
+
+
+def _encode_ops(ops: list[Op], out: bytearray) -> None:
+    cursor = 0
+    for op in ops:
+        if op[0] == "copy":
+            _, start, length = op
+            if length == 0:
+                continue
+            encode_varint((length << 1) | COPY, out)
+            encode_varint(zigzag_encode(start - cursor), out)
+            cursor = start + length
+        else:
+            data = op[1].encode('utf-8')
+            if not data:
+                continue
+            encode_varint((len(data) << 1) | INSERT, out)
+            out += data
+
+
+def _decode_ops(patch: bytes, offset: int, end: int) -> Iterator[Op]:
+    cursor = 0
+    while offset < end:
+        header, offset = decode_varint(patch, offset)
+        length = header >> 1
+        if header & 1 == COPY:
+            delta, offset = decode_varint(patch, offset)
+            start = cursor + zigzag_decode(delta)
+            cursor = start + length
+            yield ("copy", start, length)
+        else:
+            yield ("insert", patch[offset:offset + length].decode('utf-8'))
+            offset += length
+
+
+def _apply_ops(source: str, patch: bytes, offset: int, end: int) -> str:
+    # Decoded inline rather than via _decode_ops so each op costs one slice and
+    # no intermediate tuples; the result is joined once at the end.
+    pieces = []
+    append = pieces.append
+    cursor = 0
+    while offset < end:
+        header, offset = decode_varint(patch, offset)
+        length = header >> 1
+        if header & 1 == COPY:
+            delta, offset = decode_varint(patch, offset)
+            start = cursor + zigzag_decode(delta)
+            cursor = start + length
+            append(source[start:cursor])
+        else:
+            append(patch[offset:offset + length].decode('utf-8'))
+            offset += length
+    return "".join(pieces)
+
+
+# Row patch format (version 2), used between framebuffer states:
+#   version byte, then one op per run of target rows, each with a varint
+#   header (value << 2) | kind. Source rows are addressed by their offset from
+#   the target row (zigzag), so a scrolled screen is a single ROW_MOVE.
+#     ROW_MOVE:    value = offset, followed by a varint count of rows copied unchanged
+#     ROW_PATCH:   value = offset, followed by a varint length and that many
+#                  bytes of version 1 ops (without the version byte) against the source row
+#     ROW_LITERAL: value = length, followed by that many bytes of UTF-8
+ROW_PATCH_VERSION = 2
+
+ROW_MOVE = 0
+ROW_PATCH = 1
+ROW_LITERAL = 2
+
+# ("move", offset, count), ("patch", offset, ops) or ("literal", text)
+RowOp = Union[tuple[str, int, int], tuple[str, int, list[Op]], tuple[str, str]]
+
+
+def encode_rows(row_ops: list[RowOp]) -> bytes:
+    out = bytearray([ROW_PATCH_VERSION])
+    for op in row_ops:
+        if op[0] == "move":
+            _, offset, count = op
+            encode_varint((zigzag_encode(offset) << 2) | ROW_MOVE, out)
+            encode_varint(count, out)
+        elif op[0] == "patch":
+            _, offset, ops = op
+            body = bytearray()
+            _encode_ops(ops, body)
+            encode_varint((zigzag_encode(offset) << 2) | ROW_PATCH, out)
+            encode_varint(len(body), out)
+            out += body
+        else:
+            data = op[1].encode('utf-8')
+            encode_varint((len(data) << 2) | ROW_LITERAL, out)
+            out += data
+    return bytes(out)
+
+
+def apply_rows(source_rows: list[str], patch: bytes) -> list[str]:
+    assert patch[0] == ROW_PATCH_VERSION, f"Unsupported row patch version {patch[0]}"
+    rows: list[str] = []
+    offset = 1
+    end = len(patch)
+    while offset < end:
+        header, offset = decode_varint(patch, offset)
+        kind = header & 3
+        value = header >> 2
+        if kind == ROW_MOVE:
+            count, offset = decode_varint(patch, offset)
+            src = len(rows) + zigzag_decode(value)
+            rows.extend(source_rows[src:src + count])
+        elif kind == ROW_PATCH:
+            length, offset = decode_varint(patch, offset)
+            src = len(rows) + zigzag_decode(value)
+            rows.append(_apply_ops(source_rows[src], patch, offset, offset + length))
+            offset += length
+        else:
+            rows.append(patch[offset:offset + value].decode('utf-8'))
+            offset += value
+    return rows
+
+
+if __name__ == "__main__":
+    from diff import myers_opcodes
+
+    for a, b in [("", ""), ("abc", "abc"), ("", "héllo"), ("abc", ""), ("the quick fox", "the slow fox"),
+                 ("abcdef", "defabc")]:
+        ops = ops_from_opcodes(myers_opcodes(a, b), b)
+        encoded = encode(ops)
+        assert list(decode(encoded)) == [op for op in ops if op[0] != "copy" or op[2] > 0]
+        assert apply(a, encoded) == b, (a, b)
+
+    # a one character edit in a long string costs a handful of bytes
+    long = "x" * 1000
+    edited = long[:500] + "y" + long[501:]
+    assert len(encode(ops_from_opcodes(myers_opcodes(long, edited), edited))) < 10
+    # backwards copies need negative offsets
+    assert apply("abcdef", encode([("copy", 3, 3), ("copy", 0, 3)])) == "defabc"
+
+    # scroll up by one row, edit the old bottom row and add a fresh one below it
+    rows = encode_rows([("move", 1, 2), ("patch", 1, [("copy", 0, 3), ("insert", "!")]), ("literal", "new")])
+    assert apply_rows(["a", "b", "c", "top"], rows) == ["b", "c", "top!", "new"]
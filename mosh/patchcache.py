@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from typing import Callable
+
+# Patches between two state numbers never change, so the sender can reuse them
+# for retransmissions and for repeated diffs against the same acked reference.
+
+# What an entry costs besides its patch bytes: the key tuple and its ints, the
+# bytes object header, the OrderedDict slot and the by_reference index, at worst
+# one list per entry.
+# Measured with tracemalloc on CPython 3.11; without it, small patches let a
+# cache of max_bytes hold many times that much memory.
+ENTRY_OVERHEAD = 400
+
+
+class PatchCache:
+    def __init__(self, max_bytes: int = 1 << 20):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple[int, int], bytes] = OrderedDict()
+        self.by_reference: dict[int, list[int]] = {}  # old_num -> new_nums diffed against it
+        self.floor = 0  # references below this are gone, so their patches can never be asked for
+        self.size_bytes = 0  # patch bytes plus ENTRY_OVERHEAD per entry
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_generate(self, old_num: int, new_num: int, generate: Callable[[], bytes]) -> bytes:
+        key = (old_num, new_num)
+        patch = self.entries.get(key)
+        if patch is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return patch
+
+        self.misses += 1
+        patch = generate()
+        self.put(key, patch)
+        return patch
+
+    def put(self, key: tuple[int, int], patch: bytes) -> None:
+        if len(patch) + ENTRY_OVERHEAD > self.max_bytes or key[0] < self.floor:
+            return
+        self._remove(key)
+        self.entries[key] = patch
+        self.by_reference.setdefault(key[0], []).append(key[1])
+        self.size_bytes += len(patch) + ENTRY_OVERHEAD
+        while self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def drop_below(self, floor: int) -> None:
+        """Forget patches against states below floor, which the sender has dropped."""
+        for old_num in range(self.floor, floor):
+            for new_num in self.by_reference.pop(old_num, ()):
+                self._remove((old_num, new_num))
+        self.floor = max(self.floor, floor)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.by_reference.clear()
+        self.floor = 0
+        self.size_bytes = 0
+
+    def _remove(self, key: tuple[int, int]) -> None:
+        patch = self.entries.pop(key, None)
+        if patch is None:
+            return
+        self.size_bytes -= len(patch) + ENTRY_OVERHEAD
+        new_nums = self.by_reference.get(key[0])
+        if new_nums is not None:
+            new_nums.remove(key[1])
+            if not new_nums:
+                del self.by_reference[key[0]]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size_bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    calls = []
+
+    def generator(patch):
+        def generate():
+            calls.append(patch)
+            return patch
+        return generate
+
+    cache = PatchCache(max_bytes=2 * ENTRY_OVERHEAD + 10)
+    assert cache.get_or_generate(0, 1, generator(b'aaaa')) == b'aaaa'
+    assert cache.get_or_generate(0, 1, generator(b'xxxx')) == b'aaaa'
+    assert calls == [b'aaaa']
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.get_or_generate(0, 2, generator(b'bbbb'))
+    cache.get_or_generate(0, 1, generator(b'aaaa'))  # (0, 2) is now least recently used
+    cache.get_or_generate(1, 2, generator(b'cccc'))
+    assert list(cache.entries) == [(0, 1), (1, 2)]
+    assert cache.size_bytes == 8 + 2 * ENTRY_OVERHEAD and cache.evictions == 1
+
+    # patches bigger than the whole cache are never stored
+    cache.get_or_generate(2, 3, generator(b'z' * (ENTRY_OVERHEAD + 11)))
+    assert (2, 3) not in cache.entries
+    assert cache.stats()["hits"] == 2
+
+    # once the sender drops a reference its patches go too
+    cache.drop_below(1)
+    assert list(cache.entries) == [(1, 2)] and cache.size_bytes == 4 + ENTRY_OVERHEAD
+    cache.get_or_generate(0, 2, generator(b'bbbb'))
+    assert list(cache.entries) == [(1, 2)]
+
+    # the byte budget holds for memory actually used, even with tiny patches
+    import tracemalloc
+    tracemalloc.start()
+    cache = PatchCache(max_bytes=1 << 20)
+    before = tracemalloc.get_traced_memory()[0]
+    for n in range(100_000):
+        cache.put((n, n + 1), bytes(10) + n.to_bytes(4, "big"))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert used < 1.25 * cache.max_bytes, used
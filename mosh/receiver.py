@@ -1,26 +1,77 @@
+import patch
 from state import State
-from transport import TransportInstruction, Transporter
+from session import Session
+from statestore import StateStore
+from transport import TransportInstruction, Transporter, FLAG_RESYNC
 import time
 from typing import Optional, Any, Callable
 import asyncio
 import logging
+import os
 
 logging.basicConfig(
     level=logging.DEBUG,  # Set minimum log level
     format="%(asctime)s [%(levelname)s] %(message)s",
 )
 
-states: dict[int, State] = {0: State("")}
 transport: Optional[Transporter] = None
-highest_received = 0
+# "protocol" decodes packets in a DatagramProtocol callback instead of awaiting each one,
+# "batch" drains everything queued on each wakeup and only applies the newest state
+RECV_MODE = os.environ.get("MOSH_RECV_MODE", "coroutine")
 
-# Tracking for packet discards
+# Tracking for packet discards, summed over all sessions
 total_packets_received = 0
 packets_discarded = 0
+packets_superseded = 0  # applicable, but skipped for a newer state in the same batch
+packets_recovered = 0  # buffered until their reference arrived, then applied
+
+# Patches whose reference is still in flight wait in a per-session buffer of at most
+# PENDING_MAX patches; one that waited PENDING_MAX_AGE seconds is discarded.
+PENDING_MAX = int(os.environ.get("MOSH_PENDING_MAX", 64))
+PENDING_MAX_AGE = float(os.environ.get("MOSH_PENDING_MAX_AGE", 2.0))
+
+# ACKs are cumulative (they name highest_received), so they can be delayed and merged:
+# one goes out ACK_DELAY seconds after the first unacked packet, or at once when
+# ACK_EVERY packets are waiting. ACK_DELAY=0 acks every packet immediately.
+ACK_DELAY = float(os.environ.get("MOSH_ACK_DELAY", 0))
+ACK_EVERY = int(os.environ.get("MOSH_ACK_EVERY", 2))
+EMPTY_DIFF = patch.encode([])  # what every ACK carries, computed once
+acks_sent = 0
+resyncs_requested = 0
+
+
+class SessionState:
+    """Everything the receiver tracks for one client, kept on its transport Session."""
+    def __init__(self, session_id: int):
+        self.session_id = session_id
+        self.states = StateStore()
+        self.states[0] = State("")
+        self.highest_received = 0
+        self.gc_floor = 0  # every state below this has been dropped
+        # patches whose reference state has not arrived yet, by that reference: [(arrival time, instruction)]
+        self.pending: dict[int, list[tuple[float, TransportInstruction]]] = {}
+        self.pending_count = 0
+        self.acks_pending = 0
+        self.ack_timer: Optional[asyncio.TimerHandle] = None
+
+
+def session_state(session_id: Optional[int] = None) -> SessionState:
+    """The receiver state for a session, our own (the only one of a single-client setup) by default."""
+    session_id = transport.session_id if session_id is None else session_id
+    session = transport.sessions.get(session_id) or transport.sessions.touch(session_id)
+    if session.receiver is None:
+        session.receiver = SessionState(session.session_id)
+    return session.receiver
+
+
+def _on_session_evicted(session: Session) -> None:
+    if session.receiver is not None and session.receiver.ack_timer is not None:
+        session.receiver.ack_timer.cancel()
+    logging.info(f"Session {session.session_id} evicted after going idle")
 
 
 def on_receive(instruction: TransportInstruction) -> None:
-    global highest_received, total_packets_received, packets_discarded
+    global total_packets_received
 
     total_packets_received += 1
 
@@ -30,25 +81,183 @@ def on_receive(instruction: TransportInstruction) -> None:
         f"  ACK: {instruction.ack_num}, Throwaway: {instruction.throwaway_num}"
     )
 
-    if instruction.old_num in states:
-        old_state = states[instruction.old_num]
-        new_state = old_state.apply(instruction.diff)
-        states[instruction.new_num] = new_state
-        highest_received = max(highest_received, instruction.new_num)
-
-        logging.info(states[highest_received].string)
-        empty_diff = states[0].generate_patch(states[0])
-        transport.send(0, 0, instruction.new_num, instruction.new_num, empty_diff)
-        logging.debug(f"  Sent ACK for State #{instruction.new_num}")
+    session = session_state(instruction.session_id)
+    _expire_pending(session, time.monotonic())
+    if instruction.old_num in session.states:
+        _apply(session, instruction)
+    elif instruction.ack_num > session.highest_received:
+        # the sender has our ack for a state we no longer have: this session was evicted
+        # and recreated. The reference will never arrive, so ask for a fresh start.
+        _discard(instruction)
+        request_resync(session, instruction.new_num)
+    elif instruction.old_num >= session.gc_floor and PENDING_MAX > 0:
+        # the reference may still be on its way; hold on to the patch until it shows up
+        _buffer(session, instruction)
     else:
-        # TODO: Support for depending on instructions that are still in the pipeline
-        packets_discarded += 1
-        logging.error(
-            f"  ERROR: State #{instruction.old_num} not found (PACKET DISCARDED)"
-        )
-        logging.error(
-            f"  Discard stats: {packets_discarded}/{total_packets_received} = {100 * packets_discarded / total_packets_received:.2f}%"
-        )
+        _discard(instruction)
+
+    _collect_garbage(session, instruction.throwaway_num)
+
+
+def _apply(session: SessionState, instruction: TransportInstruction) -> None:
+    """Apply instruction, then every buffered patch that its new state (transitively) unblocks."""
+    global packets_recovered
+    states = session.states
+    ready = [instruction]
+    while ready:
+        instruction = ready.pop()
+        old_state = states[instruction.old_num]
+        if instruction.compressed:
+            # buffered before its reference existed, so the transport could not inflate it
+            instruction.decompress(old_state.string.encode("utf-8"))
+        states[instruction.new_num] = old_state.apply(instruction.diff)
+        session.highest_received = max(session.highest_received, instruction.new_num)
+        _schedule_ack(session)
+
+        waiting = session.pending.pop(instruction.new_num, [])
+        session.pending_count -= len(waiting)
+        packets_recovered += len(waiting)
+        ready.extend(buffered for _, buffered in waiting)
+
+    logging.info(states[session.highest_received].string)
+
+
+def _buffer(session: SessionState, instruction: TransportInstruction) -> None:
+    if session.pending_count >= PENDING_MAX:
+        _evict_pending(session, lambda arrived, buffered: True)
+    session.pending.setdefault(instruction.old_num, []).append((time.monotonic(), instruction))
+    session.pending_count += 1
+    logging.debug(f"  State #{instruction.old_num} not here yet, buffering #{instruction.new_num}")
+
+
+def _expire_pending(session: SessionState, now: float) -> None:
+    """Discard buffered patches that waited too long or whose reference has been collected."""
+    while session.pending_count > 0 and _evict_pending(
+            session, lambda arrived, buffered: now - arrived > PENDING_MAX_AGE or buffered.old_num < session.gc_floor):
+        pass
+
+
+def _evict_pending(session: SessionState, evictable: Callable[[float, TransportInstruction], bool]) -> bool:
+    """Discard the oldest buffered patch if evictable says so; returns whether one was discarded."""
+    reference, index, arrived, oldest = min(
+        ((reference, i, arrived, buffered)
+         for reference, waiting in session.pending.items()
+         for i, (arrived, buffered) in enumerate(waiting)),
+        key=lambda entry: entry[2],
+    )
+    if not evictable(arrived, oldest):
+        return False
+    waiting = session.pending[reference]
+    del waiting[index]
+    if not waiting:
+        del session.pending[reference]
+    session.pending_count -= 1
+    _discard(oldest)
+    return True
+
+
+def _discard(instruction: TransportInstruction) -> None:
+    global packets_discarded
+    packets_discarded += 1
+    logging.error(
+        f"  ERROR: State #{instruction.old_num} not found (PACKET DISCARDED)"
+    )
+    logging.error(
+        f"  Discard stats: {packets_discarded}/{total_packets_received} = {100 * packets_discarded / total_packets_received:.2f}%"
+    )
+
+
+def _collect_garbage(session: SessionState, throwaway_num: int) -> None:
+    """Drop states the sender says it will never refer to again (those below throwaway_num).
+
+    The newest state is always kept, whatever the sender says.
+    """
+    floor = min(throwaway_num, session.highest_received)
+    for state_num in range(session.gc_floor, floor):
+        if state_num in session.states:
+            del session.states[state_num]
+    session.gc_floor = max(session.gc_floor, floor)
+
+
+def _schedule_ack(session: SessionState) -> None:
+    session.acks_pending += 1
+    if ACK_DELAY <= 0 or session.acks_pending >= ACK_EVERY:
+        send_ack(session.session_id)
+    elif session.ack_timer is None:
+        session.ack_timer = asyncio.get_running_loop().call_later(ACK_DELAY, send_ack, session.session_id)
+
+
+def _clear_pending_ack(session: SessionState) -> None:
+    if session.ack_timer is not None:
+        session.ack_timer.cancel()
+        session.ack_timer = None
+    session.acks_pending = 0
+
+
+def send_ack(session_id: Optional[int] = None) -> None:
+    global acks_sent
+    session = session_state(session_id)
+    _clear_pending_ack(session)
+    transport.send(0, 0, session.highest_received, session.highest_received, EMPTY_DIFF,
+                   session_id=session.session_id)
+    acks_sent += 1
+    logging.debug(f"  Sent ACK for State #{session.highest_received} (session {session.session_id})")
+
+
+def request_resync(session: SessionState, new_num: int) -> None:
+    """Tell the sender we cannot use anything it sent up to new_num; it answers with a diff from state 0."""
+    global resyncs_requested
+    transport.send(0, new_num, session.highest_received, session.highest_received, EMPTY_DIFF,
+                   session_id=session.session_id, flags=FLAG_RESYNC)
+    resyncs_requested += 1
+    logging.info(f"  Lost the sender's state #{new_num} reference, requested a resync (session {session.session_id})")
+
+
+def send_update(old_num: int, new_num: int, throwaway_num: int, diff: bytes, session_id: Optional[int] = None) -> None:
+    """Send our own state update; it carries the ACK, so any pending one is dropped."""
+    session = session_state(session_id)
+    _clear_pending_ack(session)
+    transport.send(old_num, new_num, session.highest_received, throwaway_num, diff, session_id=session.session_id)
+
+
+def on_receive_batch(batch: list[TransportInstruction]) -> None:
+    """Apply only the newest state reachable from this batch in each session; its ACK covers the rest.
+
+    Patches on the path to that state are applied too (it may build on them).
+    Anything older than it is skipped as superseded.
+    """
+    by_session: dict[int, list[TransportInstruction]] = {}
+    for instruction in batch:
+        by_session.setdefault(instruction.session_id, []).append(instruction)
+    for session_id, instructions in by_session.items():
+        _receive_session_batch(session_state(session_id).states, instructions)
+
+
+def _receive_session_batch(states: StateStore, batch: list[TransportInstruction]) -> None:
+    global total_packets_received, packets_superseded
+
+    by_new_num = {instruction.new_num: instruction for instruction in batch}
+    path: list[TransportInstruction] = []
+    for newest in sorted(batch, key=lambda instruction: instruction.new_num, reverse=True):
+        path = [newest]
+        while path[-1].old_num not in states and path[-1].old_num in by_new_num:
+            path.append(by_new_num[path[-1].old_num])
+        if path[-1].old_num in states:
+            break
+        path = []
+
+    on_path = {id(instruction) for instruction in path}
+    for instruction in reversed(path):
+        on_receive(instruction)
+    for instruction in batch:
+        if id(instruction) in on_path:
+            continue
+        if path and instruction.new_num < path[0].new_num:
+            total_packets_received += 1
+            packets_superseded += 1
+            logging.debug(f"  State #{instruction.new_num} superseded by #{path[0].new_num} in the same batch")
+        else:
+            on_receive(instruction)
 
 
 def get_discard_stats() -> dict:
@@ -58,17 +267,62 @@ def get_discard_stats() -> dict:
         if total_packets_received > 0
         else 0.0
     )
+    # buffered patches are neither accepted nor discarded yet
+    pending = sum(s.receiver.pending_count for s in transport.sessions if s.receiver is not None)
     return {
         "total_packets_received": total_packets_received,
         "packets_discarded": packets_discarded,
-        "packets_accepted": total_packets_received - packets_discarded,
+        "packets_accepted": total_packets_received - packets_discarded - pending,
+        "packets_superseded": packets_superseded,
+        "packets_recovered": packets_recovered,
+        "packets_pending": pending,
         "discard_percentage": discard_pct,
     }
 
 
-def init(port):
+def get_ack_stats() -> dict:
+    pending = sum(s.receiver.acks_pending for s in transport.sessions if s.receiver is not None)
+    return {"acks_sent": acks_sent, "acks_pending": pending, "resyncs_requested": resyncs_requested}
+
+
+def get_state_stats() -> dict:
+    """Live states over all sessions."""
+    return {"live_states": sum(len(s.receiver.states) for s in transport.sessions if s.receiver is not None)}
+
+
+def get_session_stats() -> dict:
+    return transport.sessions.stats()
+
+
+def get_loss_stats(session_id: Optional[int] = None) -> dict:
+    """Datagram loss and reordering from one session, or summed over all of them.
+
+    Summed stats carry the mean of the sessions' loss and reorder rates.
+    """
+    if session_id is not None:
+        return transport.loss_stats(session_id)
+    per_session = [s.sequence.stats() for s in transport.sessions if s.sequence.received > 0]
+    total = {key: sum(stats[key] for stats in per_session) for key in ("received", "lost", "duplicates", "reordered")}
+    for key in ("loss_rate", "reorder_rate"):
+        total[key] = sum(stats[key] for stats in per_session) / len(per_session) if per_session else 0.0
+    bursts: dict[int, int] = {}
+    for stats in per_session:
+        for length, count in stats["burst_lengths"].items():
+            bursts[length] = bursts.get(length, 0) + count
+    total["burst_lengths"] = dict(sorted(bursts.items()))
+    return total
+
+
+def _reference_content(session_id: int, state_num: int) -> Optional[bytes]:
+    state = session_state(session_id).states.get(state_num)
+    return state.string.encode("utf-8") if state is not None else None
+
+
+def init(port, reuse_port=False):
     global transport
-    transport = Transporter("", port, None, None)
+    transport = Transporter("", port, None, None, reuse_port=reuse_port)
+    transport.reference_lookup = _reference_content
+    transport.sessions.on_evict = _on_session_evicted
 
 
 def hook(f, ti: TransportInstruction) -> None:
@@ -82,8 +336,67 @@ async def update_listener(
     receive_hook: Callable[[Any, TransportInstruction], None] = None, extra_context=None
 ):
     loop = asyncio.get_running_loop()
+
+    if RECV_MODE == "protocol":
+        def on_instruction(update: TransportInstruction) -> None:
+            on_receive(update)
+            if receive_hook is not None:
+                receive_hook(extra_context, update)
+
+        await transport.start_protocol(loop, on_instruction)
+        await loop.create_future()  # packets are handled by the callback from here on
+        return
+
+    if RECV_MODE == "batch":
+        while True:
+            batch = await transport.async_recv_batch(loop)
+            on_receive_batch(batch)
+            if receive_hook is not None:
+                for update in batch:
+                    receive_hook(extra_context, update)
+
     while True:
         update = await transport.async_recv(loop)
         on_receive(update)
         if receive_hook is not None:
             receive_hook(extra_context, update)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.CRITICAL)
+    init(0)
+    transport.other_addr = ("127.0.0.1", 9)  # acks go nowhere
+    screens = [State(text) for text in ["", "a", "ab", "abc", "abcd"]]
+
+    def instruction(old_num: int, new_num: int) -> TransportInstruction:
+        return TransportInstruction(old_num, new_num, 0, 0, screens[old_num].generate_patch(screens[new_num]))
+
+    # patches arriving in reverse wait for their references, then apply in one cascade
+    on_receive(instruction(2, 3))
+    on_receive(instruction(1, 2))
+    assert session_state().pending_count == 2 and get_discard_stats()["packets_accepted"] == 0
+    on_receive(instruction(0, 1))
+    assert session_state().highest_received == 3 and session_state().states[3].string == "abc"
+    assert packets_recovered == 2 and session_state().pending_count == 0
+    assert get_discard_stats()["packets_accepted"] == 3 and packets_discarded == 0
+
+    # a full buffer makes room by discarding the patch that has waited longest
+    PENDING_MAX = 2
+    for old_num in (10, 11, 12):
+        on_receive(TransportInstruction(old_num, old_num + 1, 0, 0, EMPTY_DIFF))
+    assert packets_discarded == 1 and sorted(session_state().pending) == [11, 12]
+
+    # patches that waited longer than PENDING_MAX_AGE are discarded on the next packet
+    PENDING_MAX_AGE = 0.01
+    time.sleep(0.02)
+    on_receive(instruction(3, 4))
+    assert packets_discarded == 3 and session_state().pending_count == 0
+    stats = get_discard_stats()
+    assert stats["packets_accepted"] == 4 and stats["packets_pending"] == 0
+
+    # a sender still diffing against states this (recreated) session never had gets asked to resync
+    transport.sessions.touch(9, ("127.0.0.1", 9))
+    stale = TransportInstruction(20, 21, 20, 0, EMPTY_DIFF)
+    stale.session_id = 9
+    on_receive(stale)
+    assert resyncs_requested == 1 and packets_discarded == 4 and session_state(9).pending_count == 0
@@ -0,0 +1,113 @@
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+# copied from the lab
+MinRTO = 0.05
+G = 0.1
+K = 4
+alpha = 0.125
+beta = 0.25
+
+# Timestamps on the wire are 16-bit milliseconds off each side's own monotonic clock.
+# A peer echoes our latest timestamp back, advanced by however long it held it, so
+# the difference to our clock is the round trip without the peer's delay.
+NO_TIMESTAMP = 0xFFFF  # sent as the echo when there is nothing fresh to echo
+ECHO_MAX_AGE = 1.0  # a timestamp held longer than this is not echoed at all
+MAX_SAMPLE = 30.0  # anything longer is a wrapped or bogus echo
+
+
+@dataclass(frozen=True)
+class RttSnapshot:
+    srtt: Optional[float]
+    rttvar: Optional[float]
+    min_rtt: Optional[float]
+    rto: Optional[float]
+    samples: int
+
+
+def _ms(now_ns: int) -> int:
+    return now_ns // 1_000_000
+
+
+class RttEstimator:
+    def __init__(self):
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+        self.min_rtt: Optional[float] = None
+        self.rto: Optional[float] = None
+        self.samples = 0
+        self.samples_discarded = 0
+        self._peer_timestamp: Optional[int] = None
+        self._peer_timestamp_received_ns = 0
+
+    def timestamp(self, now_ns: Optional[int] = None) -> int:
+        """Our clock for the outgoing packet's ts field."""
+        now_ns = time.monotonic_ns() if now_ns is None else now_ns
+        ts = _ms(now_ns) & 0xFFFF
+        return 0 if ts == NO_TIMESTAMP else ts
+
+    def echo(self, now_ns: Optional[int] = None) -> int:
+        """The ts_reply field: the peer's latest timestamp plus how long we have held it."""
+        if self._peer_timestamp is None:
+            return NO_TIMESTAMP
+        now_ns = time.monotonic_ns() if now_ns is None else now_ns
+        held_ms = _ms(now_ns - self._peer_timestamp_received_ns)
+        if held_ms > ECHO_MAX_AGE * 1000:
+            return NO_TIMESTAMP
+        echo = (self._peer_timestamp + held_ms) & 0xFFFF
+        return 0 if echo == NO_TIMESTAMP else echo
+
+    def on_timestamp(self, ts: int, now_ns: Optional[int] = None) -> None:
+        """Remember the peer's timestamp from a received packet so it can be echoed."""
+        self._peer_timestamp = ts
+        self._peer_timestamp_received_ns = time.monotonic_ns() if now_ns is None else now_ns
+
+    def on_echo(self, ts_reply: int, now_ns: Optional[int] = None) -> Optional[float]:
+        """Take an RTT sample from the ts_reply of a received packet; returns it, or None if discarded."""
+        if ts_reply == NO_TIMESTAMP:
+            return None
+        now_ns = time.monotonic_ns() if now_ns is None else now_ns
+        R = ((self.timestamp(now_ns) - ts_reply) & 0xFFFF) / 1000
+        if R > MAX_SAMPLE:
+            self.samples_discarded += 1
+            return None
+
+        # RTO estimation copied from our TCP lab (lab 1)
+        if self.rttvar is None:
+            self.srtt = R
+            self.rttvar = R / 2
+        else:
+            self.rttvar = (1 - beta) * self.rttvar + beta * abs(self.srtt - R)
+            self.srtt = (1 - alpha) * self.srtt + alpha * R
+        self.rto = max(MinRTO, self.srtt + max(G, K * self.rttvar))
+        self.min_rtt = R if self.min_rtt is None else min(self.min_rtt, R)
+        self.samples += 1
+        return R
+
+    def snapshot(self) -> RttSnapshot:
+        return RttSnapshot(self.srtt, self.rttvar, self.min_rtt, self.rto, self.samples)
+
+
+if __name__ == "__main__":
+    ms = 1_000_000
+    local, remote = RttEstimator(), RttEstimator()
+    assert local.echo() == NO_TIMESTAMP and local.snapshot().srtt is None
+
+    # 20ms each way, and the peer holds our timestamp for 100ms before its ACK goes out
+    sent = local.timestamp(now_ns=1_000 * ms)
+    remote.on_timestamp(sent, now_ns=5_020 * ms)
+    echo = remote.echo(now_ns=5_120 * ms)
+    assert local.on_echo(echo, now_ns=1_140 * ms) == 0.04
+    snap = local.snapshot()
+    assert snap.srtt == snap.min_rtt == 0.04 and snap.samples == 1
+    assert snap.rto == 0.04 + G
+
+    # stale timestamps are not echoed, and a missing echo gives no sample
+    assert remote.echo(now_ns=6_100 * ms) == NO_TIMESTAMP
+    assert local.on_echo(NO_TIMESTAMP) is None and local.samples == 1
+
+    # 16-bit wraparound
+    sent = local.timestamp(now_ns=65_530 * ms)
+    assert local.on_echo(sent, now_ns=65_560 * ms) == 0.03
+    assert local.snapshot().min_rtt == 0.03
@@ -1,12 +1,18 @@
 from inflight import InflightTracker
-from state import State
+from patchcache import PatchCache
+from state import State, STATE_MODELS
+from statestore import StateStore
 from transport import Transporter, TransportInstruction
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+import asyncio
 import socket
 import random
 import time
 import logging
 import os
-from typing import Optional, Callable, Any
+from typing import Optional, Callable, Any, Union
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -14,30 +20,258 @@ logging.basicConfig(
     filename="sender.log",
 )
 
-states = {}  # for now we store all states
+states = StateStore()  # deduplicated by content; states below retained_floor are dropped as acks come in
 states[0] = State("")
+gc_floor = 0  # every state below this has been dropped
 inflight = InflightTracker()
+patch_cache = PatchCache(int(os.environ.get("MOSH_PATCH_CACHE_BYTES", 1 << 20)))
 transport = None
 next_state_num = 1
 
 LAMBDA = float(os.environ.get("MOSH_LAMBDA", 0))
 # defines probability that we pull last known receiver state instead of the assumed receiver state
 
+REFERENCE_POLICY = os.environ.get("MOSH_REFERENCE_POLICY", "fixed")
+# "fixed" uses LAMBDA throughout, "adaptive" derives lambda from the loss we observe (see AdaptiveLossPolicy)
+DECISION_LOG_SIZE = 256  # most recent reference decisions kept for get_reference_policy_stats
+
+STATE_MODEL = os.environ.get("MOSH_STATE_MODEL", "string")
+# "framebuffer" treats each message as a grid of rows and only diffs the rows that changed
+
+# identifies this client to a server that serves many; random unless pinned via the environment
+SESSION_ID = int(os.environ["MOSH_SESSION_ID"]) if "MOSH_SESSION_ID" in os.environ else random.randrange(1, 1 << 32)
+
+# With retransmission on, if the newest state goes unacked for an RTO, resend it as a diff from the last acked state.
+# The interval doubles after every retransmission, up to RETRANSMIT_MAX_INTERVAL.
+RETRANSMIT = os.environ.get("MOSH_RETRANSMIT", "0") == "1"
+INITIAL_RTO = 1.0  # used until the first ack gives us an RTT estimate
+RETRANSMIT_MAX_INTERVAL = 2.0
+last_transmit_time: Optional[float] = None
+retransmit_backoff = 1
+retransmissions = 0
+# A receiver that lost our states (its session was evicted while we were idle) asks us to
+# start over from state 0; requests about states up to resynced_through are already handled.
+resyncs = 0
+resynced_through = 0
+
+# With pacing on, new states go out at most once per send interval: srtt * SEND_INTERVAL_SRTT_FRACTION
+# clamped to [SEND_INTERVAL_MIN, SEND_INTERVAL_MAX]. States made in between are skipped and the
+# next frame carries a diff to the newest one.
+PACING = os.environ.get("MOSH_PACING", "0") == "1"
+SEND_INTERVAL_MIN = float(os.environ.get("MOSH_SEND_INTERVAL_MIN", 0.02))
+SEND_INTERVAL_MAX = float(os.environ.get("MOSH_SEND_INTERVAL_MAX", 0.25))
+SEND_INTERVAL_SRTT_FRACTION = 0.5
+pending_frame: Optional[tuple[State, Optional[Callable], Any, float]] = None
+pending_flush: Optional[asyncio.TimerHandle] = None
+states_coalesced = 0
+
+
+@dataclass
+class ReferenceDecision:
+    time: float
+    new_num: int
+    known: int
+    assumed: int
+    chosen: int
+    reason: str  # the policy's name, or why it was not asked
+
+
+class ReferencePolicy(ABC):
+    """Chooses the reference state for each new diff: the known receiver state or the assumed one.
+
+    Subclasses implement choose() and lam(); on_sent/on_acked let them learn from the link.
+    """
+    name = "base"
+
+    def __init__(self):
+        self.decisions: deque[ReferenceDecision] = deque(maxlen=DECISION_LOG_SIZE)
+        self.counts = {"known": 0, "assumed": 0}
+
+    @abstractmethod
+    def choose(self, known: int, assumed: int) -> int:
+        ...
+
+    @abstractmethod
+    def lam(self) -> float:
+        """Current probability of choosing the known state."""
+
+    def decide(self, new_num: int, known: int, assumed: int, assumed_fresh: bool) -> int:
+        if assumed_fresh:
+            chosen, reason = self.choose(known, assumed), self.name
+        else:
+            # the assumed state was sent more than an RTO ago, so it has probably been lost
+            chosen, reason = known, "rto expired"
+        self.counts["known" if chosen == known else "assumed"] += 1
+        self.decisions.append(ReferenceDecision(time.time(), new_num, known, assumed, chosen, reason))
+        return chosen
+
+    def on_sent(self, state_num: int, now: float, rto: float) -> None:
+        pass
+
+    def on_acked(self, ack_num: int, now: float, rto: float) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.name,
+            "lambda": self.lam(),
+            **self.counts,
+            "recent": list(self.decisions)[-10:],
+        }
+
+
+class FixedLambdaPolicy(ReferencePolicy):
+    name = "fixed"
+
+    def __init__(self, lam: float = LAMBDA):
+        super().__init__()
+        self._lam = lam
+
+    def lam(self) -> float:
+        return self._lam
+
+    def choose(self, known: int, assumed: int) -> int:
+        return random.choices([known, assumed], weights=[self._lam, 1 - self._lam], k=1)[0]
+
+
+class AdaptiveLossPolicy(FixedLambdaPolicy):
+    """Lambda follows an EWMA of the loss rate, ramping from 0 at loss_low to 1 at loss_high.
+
+    A transmission counts as delivered when the receiver acks exactly that
+    state, and as lost when it goes unacked for an RTO. States passed over by a
+    later ack count as neither: a receiver that merges acks or skips superseded
+    states leaves them unacked on a loss-free link too.
+
+    link_loss, if given, returns the loss rate the transport sees on incoming
+    datagrams; lambda then follows whichever of the two estimates is higher.
+    That keeps lambda responsive to losses a cumulative ack hides.
+    """
+    name = "adaptive"
+
+    def __init__(self, loss_low: float = 0.05, loss_high: float = 0.5, gain: float = 0.1,
+                 link_loss: Optional[Callable[[], float]] = None):
+        super().__init__(0.0)
+        self.loss_low = loss_low
+        self.loss_high = loss_high
+        self.gain = gain
+        self.loss = 0.0
+        self.link_loss = link_loss
+        self._outstanding: OrderedDict[int, float] = OrderedDict()  # state -> when last sent, oldest first
+
+    def lam(self) -> float:
+        loss = max(self.loss, self.link_loss()) if self.link_loss is not None else self.loss
+        return min(1.0, max(0.0, (loss - self.loss_low) / (self.loss_high - self.loss_low)))
+
+    def choose(self, known: int, assumed: int) -> int:
+        self._lam = self.lam()
+        return super().choose(known, assumed)
+
+    def on_sent(self, state_num: int, now: float, rto: float) -> None:
+        self._expire(now, rto)
+        self._outstanding[state_num] = now
+        self._outstanding.move_to_end(state_num)
+
+    def on_acked(self, ack_num: int, now: float, rto: float) -> None:
+        if self._outstanding.pop(ack_num, None) is not None:
+            self._sample(0.0)
+        for state_num in [n for n in self._outstanding if n < ack_num]:
+            del self._outstanding[state_num]
+        self._expire(now, rto)
+
+    def _expire(self, now: float, rto: float) -> None:
+        while self._outstanding:
+            state_num, sent = next(iter(self._outstanding.items()))
+            if now - sent < rto:
+                break
+            del self._outstanding[state_num]
+            self._sample(1.0)
+
+    def _sample(self, lost: float) -> None:
+        self.loss = (1 - self.gain) * self.loss + self.gain * lost
+
+    def stats(self) -> dict:
+        link_loss = self.link_loss() if self.link_loss is not None else None
+        return {**super().stats(), "loss": self.loss, "link_loss": link_loss}
+
+
+def link_loss_rate() -> float:
+    """EWMA loss on the receiver's datagrams to us, the reverse of the path our states take."""
+    return transport.loss_stats()["loss_rate"] if transport is not None else 0.0
+
+
+REFERENCE_POLICIES = {
+    "fixed": FixedLambdaPolicy,
+    "adaptive": lambda: AdaptiveLossPolicy(link_loss=link_loss_rate),
+}
+reference_policy: ReferencePolicy = REFERENCE_POLICIES[REFERENCE_POLICY]()
+
+
+def set_reference_policy(policy: Union[str, ReferencePolicy]) -> None:
+    """Switch policies at runtime, by name or instance; the new one starts with an empty decision log."""
+    global reference_policy
+    reference_policy = REFERENCE_POLICIES[policy]() if isinstance(policy, str) else policy
+
+
+def get_reference_policy_stats() -> dict:
+    return reference_policy.stats()
+
 
 def send_message(
     message: str, send_hook: Optional[Callable] = None, extra_context: Any = None
 ) -> None:
-    global states
-    new_state = State(message)
+    """Send message as the next state; send_hook(extra_context, state_num, created_at) runs once it is sent."""
+    global pending_frame, pending_flush, states_coalesced
+    created_at = time.time()
+    new_state = STATE_MODELS[STATE_MODEL](message)
+    if not PACING:
+        _send_frame(new_state, send_hook, extra_context, created_at)
+        return
+
+    if pending_frame is not None:
+        states_coalesced += 1
+    pending_frame = (new_state, send_hook, extra_context, created_at)
+    wait = send_interval() - (created_at - last_transmit_time) if last_transmit_time is not None else 0
+    if wait <= 0:
+        _flush_frame()
+    elif pending_flush is None:
+        pending_flush = asyncio.get_running_loop().call_later(wait, _flush_frame)
+
+
+def send_interval() -> float:
+    if transport.srtt is None:
+        return SEND_INTERVAL_MIN
+    return min(SEND_INTERVAL_MAX, max(SEND_INTERVAL_MIN, transport.srtt * SEND_INTERVAL_SRTT_FRACTION))
+
+
+def _flush_frame() -> None:
+    global pending_frame, pending_flush
+    if pending_flush is not None:
+        pending_flush.cancel()
+        pending_flush = None
+    if pending_frame is not None:
+        frame, pending_frame = pending_frame, None
+        _send_frame(*frame)
+
+
+def _send_frame(new_state: State, send_hook: Optional[Callable], extra_context: Any, created_at: float) -> None:
     on_send(new_state, inflight)
     if send_hook is not None:
-        send_hook(extra_context, next_state_num - 1)
+        send_hook(extra_context, next_state_num - 1, created_at)
 
 
 def on_receive(instruction: TransportInstruction):
+    global retransmit_backoff
     logging.debug("\nReceived packet from receiver:")
     logging.debug(f"  Their ACK: {instruction.ack_num}")
+    if instruction.resync:
+        if instruction.new_num > resynced_through:
+            resync()
+        return
+    if instruction.ack_num > inflight.highest_ack:
+        retransmit_backoff = 1
     inflight.acked(instruction.ack_num)
+    reference_policy.on_acked(instruction.ack_num, time.time(), current_rto())
+    collect_garbage()
 
 
 def on_send(new_state: State, inf: InflightTracker):
@@ -47,54 +281,152 @@ def on_send(new_state: State, inf: InflightTracker):
     # The intention for this is to help cope with high packet loss
     # We offset the packet loss by being less aggressive in our reference state, meaning the chain of dependencies is shorter
 
-    global states, transport, next_state_num
+    global states, transport, next_state_num, retransmit_backoff
     assumed_receiver_state_num: int = next_state_num - 1
     known_receiver_state_num: int = inf.highest_ack
 
-    if (
+    assumed_fresh = (
         states[assumed_receiver_state_num].time_sent is not None
         and transport.timeout_threshold is not None
         and time.time() - states[assumed_receiver_state_num].time_sent
         < transport.timeout_threshold
-    ):
-        old_num = random.choices(
-            [known_receiver_state_num, assumed_receiver_state_num],
-            weights=[LAMBDA, 1 - LAMBDA],
-            k=1,
-        )[0]
-    else:
-        old_num = known_receiver_state_num
-
-    diff = states[old_num].generate_patch(new_state)
+    )
+    old_num = reference_policy.decide(
+        next_state_num, known_receiver_state_num, assumed_receiver_state_num, assumed_fresh
+    )
+
     new_num = next_state_num
     next_state_num += 1
+    diff = patch_cache.get_or_generate(
+        old_num, new_num, lambda: states[old_num].generate_patch(new_state)
+    )
     states[new_num] = new_state
     logging.debug(
         f"\nSending: State #{old_num} -> #{new_num} ('{states[old_num].string}' -> '{new_state.string}')"
     )
     logging.debug(f"  Diff: {diff}")
 
+    retransmit_backoff = 1
+    _transmit(old_num, new_num, diff, inf)
+
+
+def _transmit(old_num: int, new_num: int, diff: bytes, inf: InflightTracker) -> None:
+    global last_transmit_time
     transport.send(
         old_num,
         new_num,
         inf.highest_ack,
-        min(
-            0,
-            inf.highest_ack - 1,
-            (
-                inf.min_inflight_dependency()
-                if inf.min_inflight_dependency() is not None
-                else float("inf")
-            )
-            - 1,
-        ),
+        retained_floor(inf),
         diff,
+        # only compression needs the reference, and encoding it costs a full screen per packet
+        reference=states[old_num].string.encode("utf-8") if transport.compress else None,
     )
     inf.sent(new_num, old_num)
-    new_state.mark_sent()
+    states[new_num].mark_sent()
+    last_transmit_time = time.time()
+    reference_policy.on_sent(new_num, last_transmit_time, current_rto())
+
+
+def retained_floor(inf: InflightTracker) -> int:
+    """The oldest state either side still needs; this goes out as throwaway_num.
+
+    Every future diff is against highest_ack or something newer, and packets
+    still in flight need their references, so everything older can go.
+    """
+    floor = inf.highest_ack
+    min_dependency = inf.min_inflight_dependency()
+    if min_dependency is not None:
+        floor = min(floor, min_dependency)
+    return floor
+
+
+def collect_garbage() -> None:
+    """Drop our copies of states below retained_floor, and the cached patches against them."""
+    global gc_floor
+    floor = retained_floor(inflight)
+    for state_num in range(gc_floor, floor):
+        if state_num in states:
+            del states[state_num]
+    gc_floor = max(gc_floor, floor)
+    patch_cache.drop_below(gc_floor)
+
+
+def current_rto() -> float:
+    return transport.timeout_threshold if transport.timeout_threshold is not None else INITIAL_RTO
+
+
+def retransmit_interval() -> float:
+    return min(RETRANSMIT_MAX_INTERVAL, current_rto() * retransmit_backoff)
+
+
+def resync() -> None:
+    """Forget what the receiver acked and resend the newest state as a diff from state 0."""
+    global inflight, gc_floor, resyncs, resynced_through, retransmit_backoff
+    logging.info(f"Receiver lost its states, resyncing from state 0 (newest is #{next_state_num - 1})")
+    inflight = InflightTracker()
+    if 0 not in states:
+        states[0] = State("")
+    gc_floor = 0
+    patch_cache.clear()
+    resyncs += 1
+    resynced_through = next_state_num - 1
+    retransmit_backoff = 1
+    retransmit_latest()
+
+
+def retransmit_latest() -> bool:
+    """Resend the newest state against the last acked one; returns False if it was already acked."""
+    global retransmit_backoff, retransmissions
+    newest = next_state_num - 1
+    old_num = inflight.highest_ack
+    if old_num >= newest:
+        return False
+
+    diff = patch_cache.get_or_generate(
+        old_num, newest, lambda: states[old_num].generate_patch(states[newest])
+    )
+    logging.debug(f"\nRetransmitting: State #{old_num} -> #{newest} (backoff x{retransmit_backoff})")
+    _transmit(old_num, newest, diff, inflight)
+    retransmissions += 1
+    if retransmit_interval() < RETRANSMIT_MAX_INTERVAL:
+        retransmit_backoff *= 2
+    return True
+
+
+async def retransmit_scheduler() -> None:
+    """Run alongside the send/receive tasks; retransmits whenever the newest state sits unacked for an RTO."""
+    while RETRANSMIT:
+        interval = retransmit_interval()
+        since_last = time.time() - last_transmit_time if last_transmit_time is not None else 0
+        if since_last < interval:
+            await asyncio.sleep(interval - since_last)
+            continue
+        if not retransmit_latest():
+            await asyncio.sleep(interval)
+
+
+def get_patch_cache_stats() -> dict:
+    """Return patch cache hit/miss statistics."""
+    return patch_cache.stats()
+
+
+def get_retransmit_stats() -> dict:
+    return {"retransmissions": retransmissions, "backoff": retransmit_backoff, "resyncs": resyncs}
+
+
+def get_loss_stats() -> dict:
+    return transport.loss_stats()
+
+
+def get_state_stats() -> dict:
+    return {"live_states": len(states), "gc_floor": gc_floor, **states.stats()}
+
+
+def get_pacing_stats() -> dict:
+    return {"states_sent": next_state_num - 1, "states_coalesced": states_coalesced, "send_interval": send_interval()}
 
 
 def init(host, port):
     global transport
-    transport = Transporter("", 0, host, port)
+    transport = Transporter("", 0, host, port, session_id=SESSION_ID)
     logging.debug(f"Initialized transport {type(transport)}")
@@ -0,0 +1,142 @@
+from typing import Optional
+
+# Sequence numbers of the last WINDOW packets are remembered, so late arrivals
+# can be told apart from duplicates. A jump of more than MAX_GAP either way is
+# taken as the peer restarting its numbering (a restarted process, or a session
+# that was evicted and recreated) rather than as that many losses or duplicates.
+WINDOW = 1024
+MAX_GAP = 4096
+EWMA_GAIN = 0.05
+MAX_BURST_BUCKET = 16  # bursts at least this long share one histogram bucket
+# a peer that restarts before it got MAX_GAP ahead looks like duplicates instead;
+# this many duplicates in a row are taken as a restart too
+RESET_DUPLICATES = 16
+
+
+class SequenceTracker:
+    """Online loss, duplication and reordering estimates from one peer's datagram sequence numbers.
+
+    A gap in the sequence counts as lost until the missing packets show up;
+    one that arrives late is counted as reordered instead.
+    """
+    def __init__(self):
+        self.max_seq: Optional[int] = None
+        self._reset_seq: Optional[int] = None  # gaps are only counted above the last reset
+        self._seen = 0  # bit i set: max_seq - i has arrived
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.loss_rate = 0.0  # EWMA over packets sent, lost ones count 1
+        self.reorder_rate = 0.0  # EWMA over packets received, late ones count 1
+        self.burst_lengths: dict[int, int] = {}  # consecutive losses -> how often
+        self._duplicate_run = 0
+
+    def on_packet(self, seq: int) -> None:
+        if self.max_seq is None or abs(seq - self.max_seq) > MAX_GAP:
+            self._reset(seq)
+            return
+
+        offset = self.max_seq - seq
+        if offset >= 0 and (offset >= WINDOW or self._seen >> offset & 1):
+            self.duplicates += 1
+            self._duplicate_run += 1
+            if self._duplicate_run >= RESET_DUPLICATES:
+                # the run was the restarted peer's first packets, not duplicates
+                self.duplicates -= self._duplicate_run
+                self.received += self._duplicate_run - 1
+                self._reset(seq)
+            return
+        self._duplicate_run = 0
+
+        if offset < 0:
+            gap = -offset - 1
+            self._seen = ((self._seen << -offset) | 1) & ((1 << WINDOW) - 1)
+            self.max_seq = seq
+            self.received += 1
+            if gap:
+                self.lost += gap
+                bucket = min(gap, MAX_BURST_BUCKET)
+                self.burst_lengths[bucket] = self.burst_lengths.get(bucket, 0) + 1
+                # gap samples of 1 in one step
+                self.loss_rate = 1 - (1 - self.loss_rate) * (1 - EWMA_GAIN) ** gap
+            self.loss_rate *= 1 - EWMA_GAIN
+            self.reorder_rate *= 1 - EWMA_GAIN
+        else:
+            self._seen |= 1 << offset
+            self.received += 1
+            self.reordered += 1
+            if seq > self._reset_seq:
+                # counted as lost when we skipped past it; its sample is offset samples old,
+                # so turn that 1 back into a 0
+                self.lost -= 1
+                self.loss_rate = max(0.0, self.loss_rate - EWMA_GAIN * (1 - EWMA_GAIN) ** offset)
+            self.reorder_rate = (1 - EWMA_GAIN) * self.reorder_rate + EWMA_GAIN
+
+    def _reset(self, seq: int) -> None:
+        self.max_seq = seq
+        self._reset_seq = seq
+        self._seen = 1
+        self._duplicate_run = 0
+        self.received += 1
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "lost": self.lost,
+            "duplicates": self.duplicates,
+            "reordered": self.reordered,
+            "loss_rate": self.loss_rate,
+            "reorder_rate": self.reorder_rate,
+            "burst_lengths": dict(sorted(self.burst_lengths.items())),
+        }
+
+
+if __name__ == "__main__":
+    tracker = SequenceTracker()
+    for seq in [0, 1, 2, 5, 3, 3, 6, 10, 11]:
+        tracker.on_packet(seq)
+    stats = tracker.stats()
+    # 4, 7, 8 and 9 never arrived, 3 came late and then again
+    assert stats["received"] == 8 and stats["lost"] == 4
+    assert stats["duplicates"] == 1 and stats["reordered"] == 1
+    assert stats["burst_lengths"] == {2: 1, 3: 1}
+    assert 0 < stats["loss_rate"] < 1 and 0 < stats["reorder_rate"] < 1
+
+    # a late packet undoes exactly the loss sample it was counted as
+    tracker = SequenceTracker()
+    for seq in [0, 1, 3, 4, 5, 2]:
+        tracker.on_packet(seq)
+    assert tracker.lost == 0 and abs(tracker.loss_rate) < 1e-12
+
+    # but one from before the first packet (or a reset) was never counted as lost
+    tracker = SequenceTracker()
+    tracker.on_packet(1)
+    tracker.on_packet(0)
+    assert tracker.lost == 0 and tracker.reordered == 1 and tracker.loss_rate == 0.0
+
+    # steady 25% loss converges near 0.25
+    tracker = SequenceTracker()
+    for seq in range(20_000):
+        if seq % 4:
+            tracker.on_packet(seq)
+    assert abs(tracker.loss_rate - 0.25) < 0.05 and tracker.burst_lengths == {1: 4999}
+
+    # a restarted peer is not thousands of losses
+    tracker.on_packet(10_000_000)
+    assert tracker.lost == 4999
+
+    # nor is one that starts again from 0
+    tracker = SequenceTracker()
+    for seq in range(5000):
+        tracker.on_packet(seq)
+    for seq in range(200):
+        if seq != 100:
+            tracker.on_packet(seq)
+    assert tracker.duplicates == 0 and tracker.received == 5199 and tracker.lost == 1
+
+    # or from 0 before it got far
+    tracker = SequenceTracker()
+    for seq in list(range(300)) + list(range(100)):
+        tracker.on_packet(seq)
+    assert tracker.duplicates == 0 and tracker.received == 400 and tracker.max_seq == 99
@@ -0,0 +1,123 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, Iterator, Optional
+from fragment import Reassembler
+from rtt import RttEstimator
+from seqtrack import SequenceTracker
+
+# Every datagram names its session, so one socket can serve many clients.
+# Sessions nobody has heard from in SESSION_IDLE_TIMEOUT seconds are evicted,
+# as is the least recently seen one whenever the table is full.
+SESSION_IDLE_TIMEOUT = float(os.environ.get("MOSH_SESSION_IDLE_TIMEOUT", 300))
+MAX_SESSIONS = int(os.environ.get("MOSH_MAX_SESSIONS", 4096))
+EVICTION_INTERVAL = 1.0  # how often touch() checks for idle sessions
+
+
+class Session:
+    def __init__(self, session_id: int, addr: Optional[tuple], now: float):
+        self.session_id = session_id
+        self.addr = addr
+        self.last_seen = now
+        self.rtt = RttEstimator()
+        self.reassembler = Reassembler()
+        self.next_seq = 0  # our datagram sequence numbers towards this peer
+        self.sequence = SequenceTracker()  # loss and reordering on the peer's datagrams to us
+        self.receiver: Any = None  # the receiver's per-session state, see receiver.SessionState
+
+
+class SessionTable:
+    def __init__(self, idle_timeout: float = SESSION_IDLE_TIMEOUT, max_sessions: int = MAX_SESSIONS,
+                 pinned: Iterable[int] = ()):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.pinned = set(pinned)  # never evicted, e.g. a client's own session
+        self.on_evict: Optional[Callable[[Session], None]] = None
+        self._sessions: OrderedDict[int, Session] = OrderedDict()  # least recently seen first
+        self._next_eviction = 0.0
+        self.sessions_created = 0
+        self.sessions_evicted = 0
+
+    def touch(self, session_id: int, addr: Optional[tuple] = None, now: Optional[float] = None) -> Session:
+        """Return the session, creating it if needed, and record that we just heard from addr."""
+        now = time.monotonic() if now is None else now
+        if now >= self._next_eviction:
+            self._next_eviction = now + EVICTION_INTERVAL
+            self.evict_idle(now)
+
+        session = self._sessions.get(session_id)
+        if session is None:
+            if len(self._sessions) >= self.max_sessions:
+                self._evict_oldest()
+            session = self._sessions[session_id] = Session(session_id, addr, now)
+            if session_id not in self.pinned:
+                self.sessions_created += 1  # only count sessions peers opened
+        else:
+            self._sessions.move_to_end(session_id)
+            session.last_seen = now
+            if addr is not None:
+                session.addr = addr  # clients may roam
+        return session
+
+    def evict_idle(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_seen < self.idle_timeout:
+                break
+            if session_id not in self.pinned:
+                self._evict(session_id)
+
+    def _evict_oldest(self) -> None:
+        for session_id in self._sessions:
+            if session_id not in self.pinned:
+                self._evict(session_id)
+                return
+
+    def _evict(self, session_id: int) -> None:
+        session = self._sessions.pop(session_id)
+        self.sessions_evicted += 1
+        if self.on_evict is not None:
+            self.on_evict(session)
+
+    def get(self, session_id: int) -> Optional[Session]:
+        return self._sessions.get(session_id)
+
+    def __getitem__(self, session_id: int) -> Session:
+        return self._sessions[session_id]
+
+    def __contains__(self, session_id: int) -> bool:
+        return session_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self) -> Iterator[Session]:
+        return iter(list(self._sessions.values()))
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "created": self.sessions_created,
+            "evicted": self.sessions_evicted,
+        }
+
+
+if __name__ == "__main__":
+    table = SessionTable(idle_timeout=10, max_sessions=3, pinned=[0])
+    evicted = []
+    table.on_evict = lambda session: evicted.append(session.session_id)
+    table.touch(0, None, now=0)
+    a = table.touch(1, ("10.0.0.1", 5000), now=0)
+    assert table.touch(1, ("10.0.0.2", 5000), now=5) is a and a.addr == ("10.0.0.2", 5000)
+
+    # idle sessions go, pinned ones stay
+    table.touch(2, ("10.0.0.3", 5000), now=12)
+    assert 1 in table and 2 in table and 0 in table
+    table.touch(2, None, now=16)
+    assert evicted == [1] and 0 in table
+
+    # a full table makes room by dropping the least recently seen session
+    table.touch(3, None, now=17)
+    table.touch(4, None, now=18)
+    assert evicted == [1, 2] and len(table) == 3
+    assert table.stats() == {"sessions": 3, "created": 4, "evicted": 2}
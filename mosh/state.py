@@ -1,7 +1,9 @@
-import difflib
+import bisect
 import json
 import time
-from typing import Optional
+from typing import Optional, Union
+from diff import get_opcodes
+import patch
 
 class State:
     curr_stateno = 1
@@ -14,33 +16,34 @@ class State:
     def mark_sent(self) -> None:
         self.time_sent = time.time()
 
-    def generate_patch(self, other: 'State'):
-        """Generate a self-contained patch from old -> new."""
-        patch = []
+    def generate_patch(self, other: 'State', engine: Optional[str] = None) -> bytes:
+        """Generate a self-contained binary patch from old -> new (see patch.py for the format).
 
-        sm = difflib.SequenceMatcher(None, self.string, other.string)
+        engine selects the diff backend (see diff.ENGINES), defaulting to diff.DIFF_ENGINE.
+        """
+        opcodes = get_opcodes(self.string, other.string, engine)
+        return patch.encode(patch.ops_from_opcodes(opcodes, other.string))
 
-        for tag, i1, i2, j1, j2 in sm.get_opcodes():
-            if tag == "equal":
-                patch.append(("equal", i1, i2, j1, j2))
-            elif tag == "delete":
-                patch.append(("delete", i1, i2, self.string[i1:i2]))
-            elif tag == "insert":
-                patch.append(("insert", j1, j2, other.string[j1:j2]))
-            elif tag == "replace":
-                patch.append(("replace", i1, i2, j1, j2, self.string[i1:i2], other.string[j1:j2]))
+    def apply(self, delta: Union[bytes, str]) -> 'State':
+        if isinstance(delta, str):
+            return State(self._apply_json(delta))
+        if delta[0] == patch.ROW_PATCH_VERSION:
+            return FramebufferState.from_rows(patch.apply_rows(self._rows(), delta))
+        return type(self)(patch.apply(self.string, delta))
 
-        return json.dumps(patch)
+    def _rows(self) -> list[str]:
+        return self.string.split('\n')
 
-    def apply(self, patch: str) -> 'State':
-        result = []
+    def _apply_json(self, delta: str) -> str:
+        # JSON opcode lists from before the binary patch format
+        result = []  # whole slices, joined once at the end
 
-        for op in json.loads(patch):
+        for op in json.loads(delta):
             tag = op[0]
 
             if tag == "equal":
                 _, i1, i2, _, _ = op
-                result.extend(self.string[i1:i2])
+                result.append(self.string[i1:i2])
 
             elif tag == "delete":
                 _, i1, i2, _ = op
@@ -48,13 +51,129 @@ class State:
 
             elif tag == "insert":
                 _, _, _, new_chunk = op
-                result.extend(new_chunk)
+                result.append(new_chunk)
 
             elif tag == "replace":
                 *_, _, new_chunk = op[-2:]
-                result.extend(new_chunk)
+                result.append(new_chunk)
+
+        return "".join(result)
+
+class FramebufferState(State):
+    """A screen held as a grid of rows, each with a cached hash.
+
+    Patches between two framebuffers only diff the rows whose hash changed,
+    and rows that merely moved (e.g. scrolled) go out as row moves.
+    """
+    def __init__(self, s: str, rows: Optional[list[str]] = None):
+        super().__init__(s)
+        self.rows: list[str] = rows if rows is not None else s.split('\n')
+        self.row_hashes: list[int] = [hash(row) for row in self.rows]
+        self._rows_by_hash: Optional[dict[int, list[int]]] = None
+
+    @staticmethod
+    def from_rows(rows: list[str]) -> 'FramebufferState':
+        return FramebufferState('\n'.join(rows), rows)
+
+    def _rows(self) -> list[str]:
+        return self.rows
+
+    def _row_index(self) -> dict[int, list[int]]:
+        if self._rows_by_hash is None:
+            self._rows_by_hash = {}
+            for i, h in enumerate(self.row_hashes):
+                self._rows_by_hash.setdefault(h, []).append(i)
+        return self._rows_by_hash
+
+    def _find_row(self, row: str, h: int, preferred: list[int]) -> Optional[int]:
+        for i in preferred:
+            if 0 <= i < len(self.rows) and self.row_hashes[i] == h and self.rows[i] == row:
+                return i
+        for i in self._row_index().get(h, ()):
+            if self.rows[i] == row:
+                return i
+        return None
+
+    def generate_patch(self, other: 'State', engine: Optional[str] = None) -> bytes:
+        if not isinstance(other, FramebufferState):
+            return super().generate_patch(other, engine)
+
+        row_ops: list[patch.RowOp] = []
+        for dst, (row, h) in enumerate(zip(other.rows, other.row_hashes)):
+            last = row_ops[-1] if row_ops else None
+            # keep extending the current move run if we can, otherwise look for the row in place first
+            preferred = [dst + last[1], dst] if last is not None and last[0] == "move" else [dst]
+            src = self._find_row(row, h, preferred)
 
-        return State("".join(result))
+            if src is not None:
+                if last is not None and last[0] == "move" and last[1] == src - dst:
+                    row_ops[-1] = ("move", last[1], last[2] + 1)
+                else:
+                    row_ops.append(("move", src - dst, 1))
+                continue
+
+            ops = None
+            if dst < len(self.rows):
+                ops = patch.ops_from_opcodes(get_opcodes(self.rows[dst], row, engine), row)
+            if ops is not None and any(op[0] == "copy" for op in ops):
+                row_ops.append(("patch", 0, ops))
+            else:
+                row_ops.append(("literal", row))
+
+        return patch.encode_rows(row_ops)
+
+
+def compose(patch_ab: bytes, patch_bc: bytes) -> bytes:
+    """Combine the patches A -> B and B -> C into a single A -> C patch.
+
+    Works directly on the op lists, so B is never materialized and nothing is
+    re-diffed. Both patches must be character patches (version 1).
+    """
+    # lay the ops of A -> B out along B so copies out of B can be looked up by position
+    ab_ops = list(patch.decode(patch_ab))
+    starts = []
+    position = 0
+    for op in ab_ops:
+        starts.append(position)
+        position += op[2] if op[0] == "copy" else len(op[1])
+
+    ops: list[patch.Op] = []
+
+    def emit(op):
+        last = ops[-1] if ops else None
+        if last is not None and last[0] == op[0] == "copy" and last[1] + last[2] == op[1]:
+            ops[-1] = ("copy", last[1], last[2] + op[2])
+        elif last is not None and last[0] == op[0] == "insert":
+            ops[-1] = ("insert", last[1] + op[1])
+        else:
+            ops.append(op)
+
+    for op in patch.decode(patch_bc):
+        if op[0] == "insert":
+            emit(op)
+            continue
+        _, start, length = op
+        end = start + length
+        i = bisect.bisect_right(starts, start) - 1
+        while start < end:
+            source = ab_ops[i]
+            lo = start - starts[i]
+            if source[0] == "copy":
+                hi = min(source[2], end - starts[i])
+                emit(("copy", source[1] + lo, hi - lo))
+            else:
+                hi = min(len(source[1]), end - starts[i])
+                emit(("insert", source[1][lo:hi]))
+            start = starts[i] + hi
+            i += 1
+
+    return patch.encode(ops)
+
+
+STATE_MODELS = {
+    "string": State,
+    "framebuffer": FramebufferState,
+}
 
 if __name__ == '__main__':
     s1: State = State('abc')
@@ -63,3 +182,29 @@ if __name__ == '__main__':
     assert s2.num == 2
     delta = s1.generate_patch(s2)
     assert s1.apply(delta).string == s2.string
+    for engine in ('difflib', 'myers'):
+        s3: State = State('the quick brown fox')
+        s4: State = State('the quick red fox jumps')
+        assert s3.apply(s3.generate_patch(s4, engine)).string == s4.string
+    # old JSON opcode patches still apply
+    assert s1.apply('[["delete", 0, 2, "ab"], ["equal", 2, 3, 0, 1], ["insert", 1, 3, "de"]]').string == 'cde'
+
+    screen = [f'row {i:02d} ' + '.' * 60 for i in range(60)]
+    fb1: FramebufferState = FramebufferState('\n'.join(screen))
+    # scroll by two lines and type into the new bottom line
+    fb2: FramebufferState = FramebufferState('\n'.join(screen[2:] + ['$ ls', '$ ']))
+    row_delta = fb1.generate_patch(fb2)
+    assert len(row_delta) < 20
+    assert fb1.apply(row_delta).rows == fb2.rows
+    # a plain State on the receiving side can apply row patches too
+    assert State(fb1.string).apply(row_delta).string == fb2.string
+    fb3: FramebufferState = FramebufferState('\n'.join(screen[2:] + ['$ ls', '$ ls -la']))
+    assert fb2.apply(fb2.generate_patch(fb3)).string == fb3.string
+    assert State('').apply(State('').generate_patch(fb3)).string == fb3.string
+
+    a: State = State('the quick brown fox')
+    b: State = State('the quick red fox jumps')
+    c: State = State('a quick red fox jumps high')
+    composed = compose(a.generate_patch(b), b.generate_patch(c))
+    assert a.apply(composed).string == c.string
+    assert compose(a.generate_patch(a), a.generate_patch(b)) == a.generate_patch(b)
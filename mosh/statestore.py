@@ -0,0 +1,96 @@
+from typing import Iterator, Optional
+from state import State, FramebufferState
+
+# The testbed cycles through the same strings over and over, so many state
+# numbers end up holding identical content. The store keeps one canonical
+# buffer per distinct content and points every state number at it.
+
+
+class StateStore:
+    def __init__(self):
+        self._states: dict[int, State] = {}
+        self._content_ids: dict[int, int] = {}  # state number -> content id
+        self._ids_by_content: dict[str, int] = {}
+        self._canonical: dict[int, State] = {}  # content id -> first state seen with that content
+        self._refcounts: dict[int, int] = {}
+        self._next_content_id = 0
+
+    def __setitem__(self, num: int, state: State) -> None:
+        if num in self._states:
+            del self[num]
+
+        content_id = self._ids_by_content.get(state.string)
+        if content_id is None:
+            content_id = self._next_content_id
+            self._next_content_id += 1
+            self._ids_by_content[state.string] = content_id
+            self._canonical[content_id] = state
+            self._refcounts[content_id] = 0
+        else:
+            canonical = self._canonical[content_id]
+            state.string = canonical.string
+            if isinstance(state, FramebufferState) and isinstance(canonical, FramebufferState):
+                state.rows = canonical.rows
+                state.row_hashes = canonical.row_hashes
+
+        self._refcounts[content_id] += 1
+        self._content_ids[num] = content_id
+        self._states[num] = state
+
+    def __getitem__(self, num: int) -> State:
+        return self._states[num]
+
+    def get(self, num: int, default: Optional[State] = None) -> Optional[State]:
+        return self._states.get(num, default)
+
+    def __contains__(self, num: int) -> bool:
+        return num in self._states
+
+    def __delitem__(self, num: int) -> None:
+        del self._states[num]
+        content_id = self._content_ids.pop(num)
+        self._refcounts[content_id] -= 1
+        if self._refcounts[content_id] == 0:
+            del self._refcounts[content_id]
+            canonical = self._canonical.pop(content_id)
+            del self._ids_by_content[canonical.string]
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._states)
+
+    def content_id(self, num: int) -> int:
+        return self._content_ids[num]
+
+    def stats(self) -> dict:
+        return {
+            "states": len(self._states),
+            "unique_contents": len(self._canonical),
+            "content_chars": sum(len(s) for s in self._ids_by_content),
+        }
+
+
+if __name__ == "__main__":
+    store = StateStore()
+    store[0] = State("")
+    for i in range(1, 31):
+        store[i] = State(["abc", "cde", "edf"][i % 3])
+
+    assert len(store) == 31
+    assert store.stats()["unique_contents"] == 4
+    assert store[3].string is store[6].string
+    assert store.content_id(3) == store.content_id(30) != store.content_id(1)
+
+    # content is released once no state number refers to it
+    for i in range(1, 31, 3):
+        del store[i]
+    assert store.stats()["unique_contents"] == 3
+    assert 1 not in store and store.get(1) is None
+
+    fb1 = FramebufferState("a\nb")
+    fb2 = FramebufferState("a\nb")
+    store[100] = fb1
+    store[101] = fb2
+    assert fb2.rows is fb1.rows
@@ -76,7 +76,8 @@ async def main():
     await asyncio.gather(
             keyboard_listener(queue),
             network_listener(sender.transport, queue),
-            event_processor(queue)
+            event_processor(queue),
+            sender.retransmit_scheduler()
         )
 
 if __name__ == "__main__":
@@ -1,88 +1,243 @@
+import asyncio
+import base64
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import difflib
+import os
 import time
-from typing import Optional, Callable
-from datagram import Packet
+import zlib
+from typing import Optional, Callable, Union
+from datagram import Packet, HEADER_LENGTH
+from fragment import fragment, IP_UDP_OVERHEAD
+from rtt import RttEstimator, RttSnapshot
+from session import Session, SessionTable
+from varint import encode_varint, decode_varint, zigzag_encode, zigzag_decode
 import socket
 import logging
 
-# copied from the lab
-MinRTO = 0.05
-G = 0.1
-K = 4
-alpha = 0.125
-beta = 0.25
+# path MTU; payloads that would not fit in one datagram are fragmented (see fragment.py)
+MTU = int(os.environ.get("MOSH_MTU", 1500))
+# large enough for any UDP datagram, so a peer with a bigger MTU is never truncated
+RECV_BUFFER_SIZE = 65535
+# upper bound on datagrams decoded per readiness event in async_recv_batch
+MAX_RECV_BATCH = 64
+
+# Compress diffs with the reference state as a preset deflate dictionary
+COMPRESS = os.environ.get("MOSH_COMPRESS", "0") == "1"
+COMPRESS_LEVEL = 6
+# deflate only ever looks back 32 KiB, so that is all of the reference worth priming with
+ZDICT_MAX_BYTES = 32 * 1024
 
 class Transporter:
-    def __init__(self, binding_host: str, binding_port: int, other_host: Optional[str], other_port: Optional[int], is_receiver=False):
+    def __init__(self, binding_host: str, binding_port: int, other_host: Optional[str], other_port: Optional[int], is_receiver=False,
+                 session_id: int = 0, reuse_port: bool = False):
         self.socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            # several processes bind the same port and the kernel spreads peers across them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind((binding_host, binding_port))
         self.socket.setblocking(False)
-        self.seq = 0
-        self.last_timestamp: Optional[float] = None
-        self.other_addr: Optional[tuple] = (other_host, other_port) if (other_host is not None and other_port is not None) else None
+        # one entry per peer (address, RTT, reassembly, sequence numbers), keyed by the session id in each datagram.
+        # A client only ever has its own session; a server gets one per client.
+        self.session_id = session_id
+        self.sessions = SessionTable(pinned=[session_id])
+        other_addr = (other_host, other_port) if (other_host is not None and other_port is not None) else None
+        self.default_session: Session = self.sessions.touch(session_id, other_addr)
         self.current_signal_strength = -50
         self.remote_signal_strength = -50
-        self.srtt: Optional[float] = None
-        self.rttvar: Optional[float] = None
-        self.rto: Optional[float] = None
         self.is_receiver = is_receiver
+        self.compress = COMPRESS
+        # maps (session id, state number) to the state's content, used as the dictionary for compressed diffs
+        self.reference_lookup: Optional[Callable[[int, int], Optional[bytes]]] = None
+        # set once start_protocol hands the socket over to the event loop
+        self.datagram_transport: Optional[asyncio.DatagramTransport] = None
+        # every datagram is read into this one buffer and parsed in place
+        self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        self.mtu = MTU
+        self.next_message_id = 0
 
     def fileno(self):
         return self.socket.fileno()
     
+    @property
+    def other_addr(self) -> Optional[tuple]:
+        return self.default_session.addr
+
+    @other_addr.setter
+    def other_addr(self, addr: Optional[tuple]) -> None:
+        self.default_session.addr = addr
+
+    @property
+    def rtt(self) -> RttEstimator:
+        return self.default_session.rtt
+
+    @property
+    def srtt(self) -> Optional[float]:
+        return self.rtt.srtt
+
+    @property
+    def rto(self) -> Optional[float]:
+        return self.rtt.rto
+
     @property
     def timeout_threshold(self) -> Optional[float]:
-        return self.rto
+        return self.rtt.rto
+
+    def rtt_snapshot(self) -> RttSnapshot:
+        return self.rtt.snapshot()
+
+    def loss_stats(self, session_id: Optional[int] = None) -> dict:
+        """Loss, reordering and burst lengths seen on a peer's datagrams, see seqtrack.SequenceTracker."""
+        session = self.default_session if session_id is None else self.sessions[session_id]
+        return session.sequence.stats()
+
+    @property
+    def max_datagram_payload(self) -> int:
+        return self.mtu - IP_UDP_OVERHEAD - HEADER_LENGTH
 
     async def async_recv(self, loop) -> 'TransportInstruction':
-        raw, addr = await loop.sock_recvfrom(self.socket, 1500)
-        self.other_addr = addr
-        packet = Packet.unpack(raw)
-        self.last_timestamp = packet.ts
+        while True:
+            nbytes, addr = await loop.sock_recvfrom_into(self.socket, self._recv_buffer)
+            try:
+                instruction = self._on_datagram(self._recv_buffer, nbytes, addr)
+            except Exception:
+                # one bad datagram must not take down the listener for every session
+                logging.exception(f'Dropping undecodable datagram from {addr}')
+                continue
+            if instruction is not None:
+                return instruction
+
+    async def async_recv_batch(self, loop) -> list['TransportInstruction']:
+        """Wait until the socket is readable, then drain it until it would block.
+
+        After a burst this returns everything the kernel has queued (up to
+        MAX_RECV_BATCH) in one go instead of one datagram per wakeup.
+        """
+        batch = self._drain()
+        while not batch:
+            readable = loop.create_future()
+            fd = self.socket.fileno()
+            loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(fd)
+            batch = self._drain()
+        return batch
+
+    def _drain(self) -> list['TransportInstruction']:
+        batch = []
+        while len(batch) < MAX_RECV_BATCH:
+            try:
+                nbytes, addr = self.socket.recvfrom_into(self._recv_buffer)
+            except BlockingIOError:
+                break
+            try:
+                instruction = self._on_datagram(self._recv_buffer, nbytes, addr)
+            except Exception:
+                logging.exception(f'Dropping undecodable datagram from {addr}')
+                continue
+            if instruction is not None:
+                batch.append(instruction)
+        return batch
+
+    async def start_protocol(self, loop, on_instruction: Callable[['TransportInstruction'], None]) -> None:
+        """Switch to callback mode: decode packets as they arrive and hand each to on_instruction.
+
+        This replaces the async_recv loop. It avoids one future and one coroutine
+        step per packet.
+        """
+        self.datagram_transport, _ = await loop.create_datagram_endpoint(
+            lambda: _TransporterProtocol(self, on_instruction), sock=self.socket
+        )
+
+    def _on_datagram(self, buffer, nbytes: int, addr: tuple) -> Optional['TransportInstruction']:
+        """Decode the first nbytes of buffer, which may be reused as soon as this returns.
+
+        Returns None for a fragment that does not complete its message yet.
+        """
+        packet = Packet.unpack_from(buffer, nbytes)
+        session = self.sessions.touch(packet.session_id, addr)
         self.remote_signal_strength = packet.signal_strength_dbm
+        session.sequence.on_packet(packet.seq)
 
-        # RTO estimation copied from our TCP lab (lab 1)
-        
-        if (not self.is_receiver):
-            curr_ms_time = self._time_to_int()
-            R_ms = (curr_ms_time - packet.ts_reply) & 0xFFFF
-            R = self._int_to_seconds(R_ms) # Convert back to seconds
-            logging.debug(f'R: {R}')
-
-            if self.rttvar is None:
-                self.srtt = R
-                self.rttvar = R / 2
-                self.rto = self.srtt + max(G, K * self.rttvar)
-            else:
-                self.rttvar = (1 - beta) * self.rttvar + beta * abs(self.srtt - R)
-                self.srtt = (1 - alpha) * self.srtt + alpha * R
-                self.rto = self.srtt + max(G, K * self.rttvar)
-            
-            logging.debug(f'RTO estimate: {self.rto}')
+        sample = session.rtt.on_echo(packet.ts_reply) if not self.is_receiver else None
+        session.rtt.on_timestamp(packet.ts)
+        if sample is not None:
+            logging.debug(f'R: {sample}')
+            logging.debug(f'RTO estimate: {session.rtt.rto}')
 
-        return TransportInstruction.unmarshal(packet.payload.decode('utf-8'))
+        payload = session.reassembler.add(packet.payload)
+        if payload is None:
+            return None
+        instruction = TransportInstruction.unmarshal(payload)
+        instruction.session_id = session.session_id
+        if instruction.compressed and self.reference_lookup is not None:
+            reference = self.reference_lookup(session.session_id, instruction.old_num)
+            if reference is not None:
+                instruction.decompress(reference)
+        return instruction
 
     def set_signal_strength(self, dbm: int):
         self.current_signal_strength = dbm
 
-    def _time_to_int(self) -> int:
-        return int(1000 * time.time()) & 0xFFFF
-
-    def _int_to_seconds(self, mils: int) -> float:
-        return mils / 1000
+    def send(self, old_num: int, new_num: int, ack_num: int, throwaway_num: int, diff: bytes,
+             reference: Optional[bytes] = None, session_id: Optional[int] = None, flags: int = 0) -> None:
+        """reference is the content of state old_num; if given (and compression is on) it primes zlib.
 
-    def send(self, old_num: int, new_num: int, ack_num: int, throwaway_num: int, diff: str) -> None:
-        assert self.other_addr is not None, "Other address must be initialized to send"
-        t: TransportInstruction = TransportInstruction(old_num, new_num, ack_num, throwaway_num, diff)
-        payload: bytes = t.marshall().encode('utf-8')
-        curr_timestamp = self._time_to_int()
-        old_timestamp = self.last_timestamp or self._time_to_int()
+        session_id picks the peer, defaulting to our own session.
+        """
+        session = self.default_session if session_id is None else self.sessions[session_id]
+        assert session.addr is not None, "Other address must be initialized to send"
+        t: TransportInstruction = TransportInstruction(old_num, new_num, ack_num, throwaway_num, diff, flags)
+        if self.compress and reference is not None:
+            t.compress(reference)
+        payload: bytes = t.marshall()
+        fragments = fragment(payload, self.next_message_id, self.max_datagram_payload)
+        if len(fragments) > 1:
+            self.next_message_id += 1
+        curr_timestamp = session.rtt.timestamp()
+        old_timestamp = session.rtt.echo()
         direction = True
-        packet = Packet(direction, self.seq, curr_timestamp, old_timestamp, self.current_signal_strength, payload)
-        self.seq += 1
-        self.socket.sendto(packet.pack(), self.other_addr)
+        for piece in fragments:
+            packet = Packet(direction, session.next_seq, curr_timestamp, old_timestamp, self.current_signal_strength, piece,
+                            session.session_id)
+            session.next_seq += 1
+            if self.datagram_transport is not None:
+                self.datagram_transport.sendto(packet.pack(), session.addr)
+            else:
+                self.socket.sendto(packet.pack(), session.addr)
+
+
+class _TransporterProtocol(asyncio.DatagramProtocol):
+    def __init__(self, transporter: Transporter, on_instruction: Callable[['TransportInstruction'], None]):
+        self.transporter = transporter
+        self.on_instruction = on_instruction
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        try:
+            instruction = self.transporter._on_datagram(data, len(data), addr)
+        except Exception:
+            logging.exception(f'Dropping undecodable datagram from {addr}')
+            return
+        if instruction is not None:
+            self.on_instruction(instruction)
+
+    def error_received(self, exc: Exception) -> None:
+        logging.error(f'Socket error: {exc}')
+
+
+# Binary instruction format:
+#   version byte, flags byte (FLAG_* bits), varints old_num, new_num, ack_num, zigzag varint
+#   throwaway_num (it can go negative), then the raw diff bytes to the end.
+# Older peers sent a JSON object instead, which always starts with '{'.
+INSTRUCTION_VERSION = 1
+LEGACY_JSON_MARKER = ord('{')
+
+FLAG_ZLIB = 0x01  # diff is raw deflate primed with the reference state's content
+# from the receiver: it has lost state the sender believes acked (e.g. its session was
+# evicted and recreated), so the sender should start over from state 0
+FLAG_RESYNC = 0x02
 
 
 @dataclass
@@ -91,24 +246,147 @@ class TransportInstruction:
     new_num: int
     ack_num: int
     throwaway_num: int
-    diff: str
+    diff: Union[bytes, str]  # binary patch, or a JSON opcode list from older senders
+    flags: int = 0
+    session_id: int = field(default=0, compare=False)  # filled in from the datagram, not part of the payload
+
+    @property
+    def compressed(self) -> bool:
+        return bool(self.flags & FLAG_ZLIB)
+
+    @property
+    def resync(self) -> bool:
+        return bool(self.flags & FLAG_RESYNC)
+
+    def compress(self, reference: bytes) -> bool:
+        """Deflate the diff against reference, keeping the original if that does not make it smaller."""
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zdict=reference[-ZDICT_MAX_BYTES:])
+        deflated = compressor.compress(self.diff) + compressor.flush()
+        if len(deflated) >= len(self.diff):
+            return False
+        self.diff = deflated
+        self.flags |= FLAG_ZLIB
+        return True
+
+    def decompress(self, reference: bytes) -> None:
+        if not self.compressed:
+            return
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=reference[-ZDICT_MAX_BYTES:])
+        self.diff = decompressor.decompress(self.diff) + decompressor.flush()
+        self.flags &= ~FLAG_ZLIB
+
+    def marshall(self) -> bytes:
+        out = bytearray([INSTRUCTION_VERSION, self.flags])
+        encode_varint(self.old_num, out)
+        encode_varint(self.new_num, out)
+        encode_varint(self.ack_num, out)
+        encode_varint(zigzag_encode(self.throwaway_num), out)
+        out += self.diff
+        return bytes(out)
+
+    @staticmethod
+    def unmarshal(payload: Union[bytes, memoryview]) -> 'TransportInstruction':
+        """Parse the header in place; only the diff is copied out, since payload may be a reused buffer."""
+        version = payload[0]
+        if version == LEGACY_JSON_MARKER:
+            return TransportInstruction._unmarshal_json(str(payload, 'utf-8'))
+        assert version == INSTRUCTION_VERSION, f"Unsupported instruction version {version}"
 
-    def marshall(self):
-        return json.dumps(self.__dict__)
+        flags = payload[1]
+        offset = 2
+        old_num, offset = decode_varint(payload, offset)
+        new_num, offset = decode_varint(payload, offset)
+        ack_num, offset = decode_varint(payload, offset)
+        throwaway_num, offset = decode_varint(payload, offset)
+        return TransportInstruction(old_num, new_num, ack_num, zigzag_decode(throwaway_num), bytes(payload[offset:]), flags)
 
     @staticmethod
-    def unmarshal(json_str: str) -> 'TransportInstruction':
-        return TransportInstruction(**json.loads(json_str))
+    def _unmarshal_json(json_str: str) -> 'TransportInstruction':
+        fields = json.loads(json_str)
+        if fields.pop('diff_encoding', None) == 'base64':
+            fields['diff'] = base64.b64decode(fields['diff'])
+        return TransportInstruction(**fields)
 
 
 if __name__ == "__main__":
-    str1 = 'abc'
-    str2 = 'bcdef'
-    diff = list(difflib.unified_diff(str1.splitlines(keepends=True), str2.splitlines(keepends=True)))
-    t: TransportInstruction = TransportInstruction(1, 2, 1, 1, json.dumps(diff))
+    from state import State
+    t: TransportInstruction = TransportInstruction(1, 2, 1, -1, State('abc').generate_patch(State('bcdef')))
     t2 = TransportInstruction.unmarshal(t.marshall())
     assert t.ack_num == t2.ack_num
     assert t.diff == t2.diff
     assert t.old_num == t2.old_num
     assert t.new_num == t2.new_num
     assert t.throwaway_num == t2.throwaway_num
+    assert len(t.marshall()) == 6 + len(t.diff)
+
+    # JSON instructions from older senders still decode
+    str1 = 'abc'
+    str2 = 'bcdef'
+    diff = list(difflib.unified_diff(str1.splitlines(keepends=True), str2.splitlines(keepends=True)))
+    legacy = json.dumps({'old_num': 1, 'new_num': 2, 'ack_num': 1, 'throwaway_num': 1, 'diff': json.dumps(diff)})
+    assert TransportInstruction.unmarshal(legacy.encode('utf-8')) == TransportInstruction(1, 2, 1, 1, json.dumps(diff))
+    assert TransportInstruction.unmarshal(memoryview(t.marshall())) == t
+
+    # a redraw that repeats the reference compresses well, incompressible diffs are left alone
+    reference = State('status: ok ' * 40)
+    redraw = State('[' + 'status: ok ' * 40 + ']')
+    c = TransportInstruction(1, 2, 1, 0, State('').generate_patch(redraw))
+    original = c.diff
+    assert c.compress(reference.string.encode('utf-8'))
+    assert len(c.diff) < len(original) // 4
+    c2 = TransportInstruction.unmarshal(c.marshall())
+    assert c2.compressed
+    c2.decompress(reference.string.encode('utf-8'))
+    assert c2.diff == original and not c2.compressed
+    tiny = TransportInstruction(1, 2, 1, 0, b'\x01')
+    assert not tiny.compress(b'abc') and not tiny.compressed
+
+    # a diff bigger than the MTU goes out in fragments and comes back whole
+    receiver = Transporter('127.0.0.1', 0, None, None, is_receiver=True)
+    sender = Transporter('127.0.0.1', 0, *receiver.socket.getsockname())
+    sender.mtu = 576
+    big = State('').generate_patch(State('x' * 5000))
+    sender.send(0, 1, 0, 0, big)
+    time.sleep(0.05)
+    received = receiver._drain()
+    assert len(received) == 1 and received[0].diff == big
+    assert receiver.sessions[0].reassembler.stats()["reassembled"] == 1
+
+    # a server socket keeps one session per client, and replies go to the right one
+    clients = [Transporter('127.0.0.1', 0, *receiver.socket.getsockname(), session_id=i) for i in (7, 8)]
+    for i, client in enumerate(clients):
+        client.send(0, i + 1, 0, 0, b'\x01')
+    time.sleep(0.05)
+    received = receiver._drain()
+    assert sorted(ins.session_id for ins in received) == [7, 8] and len(receiver.sessions) == 3
+    receiver.send(0, 0, 2, 0, b'\x01', session_id=8)
+    time.sleep(0.05)
+    assert clients[0]._drain() == []
+    assert [ins.ack_num for ins in clients[1]._drain()] == [2]
+
+    # sequence numbers are per session, so replies to other clients are not gaps
+    receiver.send(0, 0, 3, 0, b'\x01', session_id=7)
+    receiver.send(0, 0, 4, 0, b'\x01', session_id=8)
+    time.sleep(0.05)
+    assert [ins.ack_num for ins in clients[1]._drain()] == [4]
+    assert clients[1].loss_stats()["received"] == 2 and clients[1].loss_stats()["lost"] == 0
+    assert receiver.loss_stats(7)["received"] == 1
+
+    # a malformed datagram is dropped without stopping async_recv
+    async def recv_after_garbage() -> 'TransportInstruction':
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM).sendto(b'\x01garbage', receiver.socket.getsockname())
+        clients[0].send(0, 5, 0, 0, b'\x01')
+        return await asyncio.wait_for(receiver.async_recv(asyncio.get_running_loop()), 1)
+    logging.disable(logging.CRITICAL)
+    assert asyncio.run(recv_after_garbage()).new_num == 5
+    logging.disable(logging.NOTSET)
+
+    # and so is a peer from before session ids and binary instructions
+    from datagram import LEGACY_HEADER
+    from rtt import NO_TIMESTAMP
+    legacy_datagram = LEGACY_HEADER.pack(1 << 63, 0, NO_TIMESTAMP, -50) + legacy.encode('utf-8')
+    socket.socket(socket.AF_INET, socket.SOCK_DGRAM).sendto(legacy_datagram, receiver.socket.getsockname())
+    time.sleep(0.05)
+    received = receiver._drain()
+    assert [(ins.new_num, ins.session_id) for ins in received] == [(2, 0)]
@@ -0,0 +1,43 @@
+# LEB128-style unsigned varints, plus zigzag for the few fields that can go negative
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    assert value >= 0, "varints are unsigned, zigzag encode negative values first"
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, offset: int) -> tuple[int, int]:
+    """Decode a varint from data starting at offset, returning (value, next_offset)."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def zigzag_encode(value: int) -> int:
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def zigzag_decode(value: int) -> int:
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+if __name__ == "__main__":
+    for n in [0, 1, 127, 128, 300, 16383, 16384, (1 << 63) - 1]:
+        buf = bytearray()
+        encode_varint(n, buf)
+        assert decode_varint(buf, 0) == (n, len(buf))
+    buf = bytearray()
+    encode_varint(127, buf)
+    assert len(buf) == 1
+    for n in [0, -1, 1, -64, 64, -(1 << 40)]:
+        assert zigzag_decode(zigzag_encode(n)) == n
+    assert zigzag_encode(-1) == 1 and zigzag_encode(1) == 2
@@ -33,6 +33,12 @@ class TerminationEvent:
 
 async def network_listener(t: Transporter, queue):
     loop = asyncio.get_running_loop()
+    if os.getenv("MOSH_RECV_MODE", "coroutine") == "protocol":
+        # ACKs are handled straight from the datagram callback, skipping the queue
+        await t.start_protocol(loop, sender.on_receive)
+        await loop.create_future()
+        return
+
     while True:
         instruction = await t.async_recv(loop)
         await queue.put(RemoteEvent(instruction))
@@ -106,9 +112,9 @@ async def event_processor(queue):
                 return
 
 
-def hook(fout, stateno):
-    ts = time.time()
-    fout.write(f"{ts}, {stateno}\n")
+def hook(fout, stateno, ts):
+    # ts is when the state was created, which is earlier than now if pacing held it back
+    fout.write(f"{ts}, {stateno}, {sender.SESSION_ID}\n")
     fout.flush()
 
 
@@ -128,6 +134,7 @@ async def main():
         automated_writer(queue),
         network_listener(sender.transport, queue),
         event_processor(queue),
+        sender.retransmit_scheduler(),
     )
 
     while True:
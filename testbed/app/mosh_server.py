@@ -8,17 +8,20 @@ import time
 import sys
 import os
 import signal
+import multiprocessing
+import queue
 
 sys.path.insert(0, "/app/mosh")
 import asyncio
-from receiver import update_listener, init, get_discard_stats
+from receiver import update_listener, init, get_discard_stats, get_session_stats
 from transport import TransportInstruction
 
 
 def hook(f, ti: TransportInstruction) -> None:
     ts = time.time()
     state_num = ti.new_num
-    f.write(f"{ts}, {state_num}\n")
+    # one line per state and client session: the log is shared by every session (and worker)
+    f.write(f"{ts}, {state_num}, {ti.session_id}\n")
     f.flush()
 
 
@@ -45,16 +48,23 @@ def wait_for_network_ready(sentinel_path="/artifacts/netem_ready.json", timeout=
     raise TimeoutError(f"Network conditions not ready after {timeout}s")
 
 
-def save_discard_stats():
+def save_discard_stats(stats=None, workers=1):
     """Save packet discard statistics to file"""
     try:
-        stats = get_discard_stats()
+        if stats is None:
+            stats = get_discard_stats()
+            stats["sessions"] = get_session_stats()["created"]
         stats_file = "/artifacts/discard_stats.txt"
         with open(stats_file, "w") as f:
             f.write(f"Total packets received: {stats['total_packets_received']}\n")
             f.write(f"Packets discarded: {stats['packets_discarded']}\n")
             f.write(f"Packets accepted: {stats['packets_accepted']}\n")
             f.write(f"Packets discarded (%): {stats['discard_percentage']:.4f}\n")
+            f.write(f"Packets superseded: {stats['packets_superseded']}\n")
+            f.write(f"Packets recovered: {stats['packets_recovered']}\n")
+            f.write(f"Sessions: {stats['sessions']}\n")
+            if workers > 1:
+                f.write(f"Workers: {workers}\n")
         print(
             f"[SERVER] Saved discard stats: {stats['packets_discarded']}/{stats['total_packets_received']} = {stats['discard_percentage']:.2f}%"
         )
@@ -62,30 +72,107 @@ def save_discard_stats():
         print(f"[SERVER] Error saving discard stats: {e}")
 
 
-async def main():
-    UDP_PORT = int(os.getenv("UDP_PORT", "5000"))
+def aggregate_stats(per_worker):
+    """Sum the workers' discard statistics into one report"""
+    total = {
+        key: sum(stats[key] for stats in per_worker)
+        for key in ("total_packets_received", "packets_discarded", "packets_accepted", "packets_superseded",
+                    "packets_recovered", "sessions")
+    }
+    total["discard_percentage"] = (
+        100.0 * total["packets_discarded"] / total["total_packets_received"]
+        if total["total_packets_received"] > 0
+        else 0.0
+    )
+    return total
 
-    # Wait for network conditions to be ready
-    print("[SERVER] Starting mosh server")
-    wait_for_network_ready()
 
-    init(UDP_PORT)
+async def serve(port, reuse_port=False, on_exit=save_discard_stats, log_mode="w"):
+    init(port, reuse_port=reuse_port)
 
     # Setup signal handler to save stats on exit
     def signal_handler(signum, frame):
         print(f"[SERVER] Received signal {signum}, saving stats...")
-        save_discard_stats()
+        on_exit()
         sys.exit(0)
 
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
     try:
-        with open("/logs/output.log", "w") as fout:
+        with open("/logs/output.log", log_mode) as fout:
             await update_listener(receive_hook=hook, extra_context=fout)
     finally:
-        save_discard_stats()
+        on_exit()
+
+
+def run_worker(index, port, results):
+    """One of several processes sharing the port; reports its stats to the launcher on exit"""
+    reported = False
+
+    def report():
+        nonlocal reported
+        if reported:
+            return
+        reported = True
+        stats = get_discard_stats()
+        stats["sessions"] = get_session_stats()["created"]
+        results.put((index, stats))
+
+    print(f"[SERVER] Worker {index} (pid {os.getpid()}) listening on port {port}")
+    # all workers append to the log the launcher truncated; each line is a single write
+    asyncio.run(serve(port, reuse_port=True, on_exit=report, log_mode="a"))
+
+
+def run_workers(port, workers):
+    """Fork workers that each bind port with SO_REUSEPORT, then merge their stats on shutdown"""
+    open("/logs/output.log", "w").close()
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=run_worker, args=(i, port, results)) for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    def shutdown(signum, frame):
+        print(f"[SERVER] Received signal {signum}, stopping {workers} workers...")
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    per_worker = {}
+    while len(per_worker) < workers:
+        try:
+            index, stats = results.get(timeout=1)
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                break
+            continue
+        per_worker[index] = stats
+    for process in processes:
+        process.join()
+
+    for index, stats in sorted(per_worker.items()):
+        print(f"[SERVER] Worker {index}: {stats['total_packets_received']} packets, {stats['packets_discarded']} discarded")
+    save_discard_stats(aggregate_stats(list(per_worker.values())), workers)
+
+
+def main():
+    UDP_PORT = int(os.getenv("UDP_PORT", "5000"))
+    # >1 shards clients across processes; the kernel keeps each client address on one worker
+    WORKERS = int(os.getenv("MOSH_SERVER_WORKERS", "1"))
+
+    # Wait for network conditions to be ready
+    print("[SERVER] Starting mosh server")
+    wait_for_network_ready()
+
+    if WORKERS > 1:
+        run_workers(UDP_PORT, WORKERS)
+    else:
+        asyncio.run(serve(UDP_PORT))
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()